@@ -4,7 +4,7 @@ import web
 import git
 import settings
 import feed.atom
-from jinja import Environment, FunctionLoader
+from templates import tenv
 
 
 urls = (
@@ -14,12 +14,8 @@ urls = (
     '/(.*)', 'page',
 )
 
-# Template environment
-def load_template(templ):
-    (res, err) = git.show(settings.templates + '/' + templ)
-    return res
-
-tenv = Environment(loader=FunctionLoader(load_template))
+if settings.profile:
+    urls = ('/_profile', 'profile') + urls
 
 class index:
     def GET(self):
@@ -40,6 +36,22 @@ def dirify(start, list):
     result += '</table>\n'
     return result
 
+# Render times of the templates, slowest first
+class profile:
+    def GET(self):
+        result = '<table>\n'
+        result += '\t<tr><th>kind</th><th>template</th><th>name</th>' \
+                  '<th>calls</th><th>total ms</th><th>average ms</th>' \
+                  '<th>max ms</th></tr>\n'
+        for s in tenv.profiler.get_stats():
+            result += '\t<tr><td>%s</td><td>%s</td><td>%s</td><td>%d</td>' \
+                      '<td>%.3f</td><td>%.3f</td><td>%.3f</td></tr>\n' % (
+                      s['kind'], web.websafe(s['template']),
+                      web.websafe(s['name']), s['calls'], s['total'] * 1000,
+                      s['average'] * 1000, s['max'] * 1000)
+        result += '</table>\n'
+        print result
+
 # Get jinja comments that define the template dict to send.
 # something like:
 #    {# template : sometemplate.html #}
@@ -25,6 +25,41 @@ def ls(file=None, name=False, rev=settings.revision):
     (out, err, ret) = git_call(final)
     return (out.splitlines(), ret)
 
+# Map the paths of all blobs below a tree to their SHA
+def blobs(file=None, rev=settings.revision):
+    (out, ret) = ls(file=file, rev=rev)
+    res = {}
+    for line in out:
+        (info, path) = line.split('\t', 1)
+        (mode, kind, sha) = info.split()
+        if kind == 'blob':
+            res[path] = sha
+    return (res, ret)
+
+# Changes whenever the ref `rev` is based on moves, without running git
+def refs_stamp(rev=settings.revision, repo=settings.repo):
+    name = rev.split('^')[0].split('~')[0]
+    paths = ['HEAD', 'packed-refs']
+    if name == 'HEAD':
+        try:
+            head = open(os.path.join(repo, 'HEAD')).read().strip()
+        except IOError:
+            head = ''
+        if head.startswith('ref: '):
+            paths.append(head[5:])
+    else:
+        paths += [name, 'refs/heads/' + name, 'refs/tags/' + name]
+    res = []
+    for path in paths:
+        try:
+            st = os.stat(os.path.join(repo, path))
+        except OSError:
+            res.append(None)
+        else:
+            # refs are replaced by renames, so the inode changes too
+            res.append((st.st_ino, st.st_mtime, st.st_size))
+    return tuple(res)
+
 def type(file, rev=settings.revision):
     (out, err, ret) = git_call("cat-file -t %s:%s" % (rev, file))
     return (out.strip(), ret)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja.bundle
+    ~~~~~~~~~~~~
+
+    Precompiled template bundles.
+
+    A bundle is a single file with the bytecode of many templates that is
+    written once (for example while deploying) and loaded with
+    `TemplateBundle` when the application starts. The file is mapped into
+    memory, so forked worker processes share its pages, and the templates
+    are only unmarshalled when they are requested for the first time.
+
+    Every entry is stored under a key that identifies the source of the
+    template (for example the hash of the source) together with the
+    versions of the templates it extends or includes. `BundleLoaderMixin`
+    in `jinja.loaders` uses that to only serve entries that are still up
+    to date.
+
+    :copyright: 2007 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import mmap
+import struct
+import marshal
+import tempfile
+from threading import Lock
+from jinja.translators.python import Template
+
+
+__all__ = ['TemplateBundle', 'write_bundle']
+
+
+#: magic header of bundle files, the last byte is the format version
+bundle_magic = 'JINJABUNDLE\x01'
+
+#: the header is followed by the offset of the index
+_offset_format = '<Q'
+_header_size = len(bundle_magic) + struct.calcsize(_offset_format)
+
+
+def write_bundle(filename, entries):
+    """
+    Write a bundle. `entries` is an iterable of ``(key, template,
+    versions)`` tuples where `versions` is a list of ``(name, version)``
+    tuples for the dependencies of the template. The file is replaced
+    atomically so running processes never see half written bundles.
+    """
+    folder = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=folder)
+    f = os.fdopen(fd, 'wb')
+    try:
+        try:
+            index = {}
+            f.write(bundle_magic + struct.pack(_offset_format, 0))
+            pos = _header_size
+            for key, tmpl, versions in entries:
+                data = marshal.dumps((tmpl.dump(), tuple(versions)))
+                f.write(data)
+                index[key] = (pos, len(data))
+                pos += len(data)
+            f.write(marshal.dumps(index))
+            f.seek(len(bundle_magic))
+            f.write(struct.pack(_offset_format, pos))
+        finally:
+            f.close()
+        try:
+            os.rename(tmp, filename)
+        except OSError:
+            # windows doesn't replace existing files on rename
+            os.remove(filename)
+            os.rename(tmp, filename)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class TemplateBundle(object):
+    """
+    Gives access to the templates of a bundle written by `write_bundle`.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        f = file(filename, 'rb')
+        try:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        if self._map[:len(bundle_magic)] != bundle_magic:
+            self._map.close()
+            raise ValueError('%r is not a template bundle' % filename)
+        pos = struct.unpack(_offset_format,
+                            self._map[len(bundle_magic):_header_size])[0]
+        self._index = marshal.loads(self._map[pos:])
+        self._loaded = {}
+        self._lock = Lock()
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        """Return a list of all keys."""
+        return self._index.keys()
+
+    def get(self, environment, key):
+        """
+        Return a tuple ``(template, versions)`` for the entry `key` or
+        `None` if the bundle doesn't have it. Templates are unmarshalled
+        once per environment.
+        """
+        cache_key = (id(environment), key)
+        rv = self._loaded.get(cache_key)
+        if rv is not None and rv[0].environment is environment:
+            return rv
+        if key not in self._index:
+            return None
+        pos, length = self._index[key]
+        data, versions = marshal.loads(self._map[pos:pos + length])
+        rv = (Template.load(environment, data), versions)
+        self._lock.acquire()
+        try:
+            self._loaded[cache_key] = rv
+        finally:
+            self._lock.release()
+        return rv
+
+    def close(self):
+        """Unmap the bundle file."""
+        self._map.close()
+        self._index = {}
+        self._loaded.clear()
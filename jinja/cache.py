@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja.cache
+    ~~~~~~~~~~~
+
+    Backends for the ``{% cache %}`` tag. Pass an instance of one of those
+    classes as `fragment_cache` to the environment::
+
+        from jinja import Environment
+        from jinja.cache import MemoryCache
+
+        env = Environment(fragment_cache=MemoryCache(200))
+
+    Now sections wrapped in ``{% cache key, timeout %}`` are only rendered
+    if the cache doesn't know the key or the timeout (in seconds) expired::
+
+        {% cache 'sidebar', 300 %}
+          {% for year, posts in archive|groupby('year') %}...{% endfor %}
+        {% endcache %}
+
+    The key can be any expression. It's stored together with the name of
+    the template, so the same key in two templates doesn't refer to the
+    same fragment. If the timeout is omitted or ``0`` the fragment never
+    expires. Note that the section is rendered in its own
+    scope and that variables set in a cached section are not set on a
+    cache hit.
+
+    Backends are objects with a `get`, `set`, `delete` and `clear` method
+    so it's easy to plug in other stores, see `BaseCache`. The same
+    backends can be used by the `TieredLoaderMixin` to share compiled
+    templates between processes.
+
+    :copyright: 2007 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import os
+import marshal
+import tempfile
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+from time import time
+from threading import Lock, local
+from jinja.utils import CacheDict
+
+
+__all__ = ['BaseCache', 'MemoryCache', 'FileSystemCache', 'SqliteCache',
+           'MemcachedCache']
+
+
+def get_key_hash(key):
+    """Return a hash for a key that's safe to use as filename."""
+    return sha1(repr(key)).hexdigest()
+
+
+def get_expiry(timeout):
+    """
+    Return the timestamp a fragment stored now with `timeout` expires or
+    `None` if it never expires.
+    """
+    if not timeout:
+        return None
+    return time() + timeout
+
+
+class BaseCache(object):
+    """
+    Interface for fragment caches. Subclasses have to implement `get` and
+    `set`. The default implementations of `delete` and `clear` do
+    nothing.
+    """
+
+    def get(self, key):
+        """
+        Return the fragment for `key` or `None` if it's not cached or
+        expired.
+        """
+        raise NotImplementedError()
+
+    def set(self, key, value, timeout=None):
+        """
+        Store a fragment for `timeout` seconds. `None` or ``0`` means
+        forever.
+        """
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """Forget a fragment."""
+
+    def clear(self):
+        """Forget all fragments."""
+
+
+class MemoryCache(BaseCache):
+    """
+    Keeps the fragments in the process. If the cache holds more than
+    `capacity` fragments (or more than `max_size` characters if given)
+    the least recently used fragments are dropped.
+    """
+
+    def __init__(self, capacity=100, max_size=None):
+        self._cache = CacheDict(capacity, max_size, self._weigh)
+        self._lock = Lock()
+
+    def _weigh(item):
+        return len(item[1])
+    _weigh = staticmethod(_weigh)
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            item = self._cache.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires is not None and expires < time():
+                del self._cache[key]
+                return None
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, timeout=None):
+        self._lock.acquire()
+        try:
+            self._cache[key] = (get_expiry(timeout), value)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            if key in self._cache:
+                del self._cache[key]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+
+class FileSystemCache(BaseCache):
+    """
+    Stores the fragments in a folder so that they are shared between
+    processes and survive restarts. Files are replaced atomically so
+    concurrent readers never see half written fragments.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def get_filename(self, key):
+        """Return the filename for a key."""
+        return os.path.join(self.folder, 'jinja_fragment_%s.cache' %
+                            get_key_hash(key))
+
+    def get(self, key):
+        filename = self.get_filename(key)
+        try:
+            f = file(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                expires, value = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                return None
+        finally:
+            f.close()
+        if expires is not None and expires < time():
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, timeout=None):
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.folder)
+        f = os.fdopen(fd, 'wb')
+        try:
+            marshal.dump((get_expiry(timeout), value), f)
+        finally:
+            f.close()
+        filename = self.get_filename(key)
+        try:
+            os.rename(tmp, filename)
+        except OSError:
+            # windows doesn't replace existing files on rename
+            try:
+                os.remove(filename)
+                os.rename(tmp, filename)
+            except OSError:
+                os.remove(tmp)
+
+    def delete(self, key):
+        try:
+            os.remove(self.get_filename(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for filename in os.listdir(self.folder):
+            if filename.startswith('jinja_fragment_') and \
+               filename.endswith('.cache'):
+                try:
+                    os.remove(os.path.join(self.folder, filename))
+                except OSError:
+                    pass
+
+
+class SqliteCache(BaseCache):
+    """
+    Stores the fragments in a sqlite database. Like the `FileSystemCache`
+    it's shared between processes but it doesn't need one file per
+    fragment. Every thread uses its own connection.
+    """
+
+    def __init__(self, filename, table='jinja_cache'):
+        try:
+            import sqlite3
+        except ImportError:
+            try:
+                from pysqlite2 import dbapi2 as sqlite3
+            except ImportError:
+                raise RuntimeError('the %r cache requires an installed '
+                                   'sqlite module' % self.__class__.__name__)
+        self._connect = sqlite3.connect
+        self.filename = filename
+        self.table = table
+        self._local = local()
+        self._execute('create table if not exists %s (key text primary key, '
+                      'expires real, value blob)' % table)
+
+    def _execute(self, query, *args):
+        con = getattr(self._local, 'connection', None)
+        if con is None:
+            con = self._connect(self.filename, timeout=30,
+                                isolation_level=None)
+            self._local.connection = con
+        return con.execute(query, args)
+
+    def get(self, key):
+        row = self._execute('select expires, value from %s where key = ?' %
+                            self.table, get_key_hash(key)).fetchone()
+        if row is None:
+            return None
+        expires, value = row
+        if expires is not None and expires < time():
+            self.delete(key)
+            return None
+        return marshal.loads(str(value))
+
+    def set(self, key, value, timeout=None):
+        self._execute('insert or replace into %s values (?, ?, ?)' %
+                      self.table, get_key_hash(key), get_expiry(timeout),
+                      buffer(marshal.dumps(value)))
+
+    def delete(self, key):
+        self._execute('delete from %s where key = ?' % self.table,
+                      get_key_hash(key))
+
+    def clear(self):
+        self._execute('delete from %s' % self.table)
+
+
+class MemcachedCache(BaseCache):
+    """
+    Stores the fragments on memcached servers. Requires the memcache
+    library from `tummy`_ or the cmemcache library unless a `client` is
+    given which can be any object with the `get`, `set` and `delete`
+    methods of those clients.
+
+    Because memcached can't forget just the keys of one application
+    `clear` does nothing.
+
+    .. _tummy: http://www.tummy.com/Community/software/python-memcached/
+    """
+
+    def __init__(self, servers=None, client=None, key_prefix='jinja/'):
+        if client is None:
+            try:
+                try:
+                    from cmemcache import Client
+                except ImportError:
+                    from memcache import Client
+            except ImportError:
+                raise RuntimeError('the %r cache requires an installed '
+                                   'memcache module' % self.__class__.__name__)
+            client = Client(list(servers or ['127.0.0.1:11211']))
+        self.client = client
+        self.key_prefix = key_prefix
+
+    def get(self, key):
+        return self.client.get(self.key_prefix + get_key_hash(key))
+
+    def set(self, key, value, timeout=None):
+        self.client.set(self.key_prefix + get_key_hash(key), value,
+                        timeout or 0)
+
+    def delete(self, key):
+        self.client.delete(self.key_prefix + get_key_hash(key))
@@ -329,8 +329,14 @@ class Context(BaseContext):
 class LoopContext(object):
     """
     Simple class that provides special loop variables.
-    Used by `Environment.iterate`.
+    Used by the python translator for loops that access `loop`.
+
+    The state of the current loop level lives in the slots, recursive
+    loops save the state of the outer level on a stack. Sequences without
+    a length are only copied into a list if the length is accessed.
     """
+    __slots__ = ('loop_function', 'parent', 'index0', '_length',
+                 '_iterator', '_rest', '_stack')
 
     jinja_allowed_attributes = ['index', 'index0', 'length', 'parent',
                                 'even', 'odd', 'revindex0', 'revindex',
@@ -339,6 +345,10 @@ class LoopContext(object):
     def __init__(self, seq, parent, loop_function):
         self.loop_function = loop_function
         self.parent = parent
+        self.index0 = -1
+        self._length = 0
+        self._iterator = iter(())
+        self._rest = None
         self._stack = []
         if loop_function is None:
             self.push(seq)
@@ -348,51 +358,58 @@ class LoopContext(object):
         Push a sequence to the loop stack. This is used by the
         recursive for loop.
         """
+        if self.loop_function is not None:
+            self._stack.append((self.index0, self._length, self._iterator,
+                                self._rest))
         # iteration over None is catched, but we don't catch iteration
         # over undefined because that behavior is handled in the
         # undefined singleton
         if seq is None:
             seq = ()
-            length = 0
-        else:
-            try:
-                length = len(seq)
-            except (AttributeError, TypeError):
-                seq = list(seq)
-                length = len(seq)
-        self._stack.append({
-            'index':            -1,
-            'seq':              seq,
-            'length':           length
-        })
+        try:
+            self._length = len(seq)
+        except (AttributeError, TypeError):
+            self._length = None
+        self._iterator = iter(seq)
+        self._rest = None
+        self.index0 = -1
         return self
 
     def pop(self):
         """Remove the last layer from the loop stack."""
-        return self._stack.pop()
-
-    iterated = property(lambda s: s._stack[-1]['index'] > -1)
-    index0 = property(lambda s: s._stack[-1]['index'])
-    index = property(lambda s: s._stack[-1]['index'] + 1)
-    revindex0 = property(lambda s: s._stack[-1]['length'] -
-                                   s._stack[-1]['index'] - 1)
-    revindex = property(lambda s: s._stack[-1]['length'] -
-                                  s._stack[-1]['index'])
-    length = property(lambda s: s._stack[-1]['length'])
-    even = property(lambda s: s._stack[-1]['index'] % 2 == 1)
-    odd = property(lambda s: s._stack[-1]['index'] % 2 == 0)
-    first = property(lambda s: s._stack[-1]['index'] == 0)
-    last = property(lambda s: s._stack[-1]['index'] ==
-                              s._stack[-1]['length'] - 1)
+        self.index0, self._length, self._iterator, self._rest = \
+            self._stack.pop()
+
+    def length(self):
+        if self._length is None:
+            self._rest = list(self._iterator)
+            self._length = self.index0 + 1 + len(self._rest)
+        return self._length
+    length = property(length)
+
+    iterated = property(lambda s: s.index0 > -1)
+    index = property(lambda s: s.index0 + 1)
+    revindex0 = property(lambda s: s.length - s.index0 - 1)
+    revindex = property(lambda s: s.length - s.index0)
+    even = property(lambda s: s.index0 % 2 == 1)
+    odd = property(lambda s: s.index0 % 2 == 0)
+    first = property(lambda s: s.index0 == 0)
+    last = property(lambda s: s.index0 == s.length - 1)
 
     def __iter__(self):
-        s = self._stack[-1]
-        for idx, item in enumerate(s['seq']):
-            s['index'] = idx
+        for self.index0, item in enumerate(self._iterator):
             yield item
+        # the length was requested while iterating, the items left
+        # were moved into a list
+        rest = self._rest
+        if rest:
+            offset = self.index0 + 1
+            for index, item in enumerate(rest):
+                self.index0 = offset + index
+                yield item
 
     def __len__(self):
-        return self._stack[-1]['length']
+        return self.length
 
     def __call__(self, seq):
         if self.loop_function is not None:
@@ -402,7 +419,7 @@ class LoopContext(object):
                                    'modifier.')
 
     def __repr__(self):
-        if self._stack:
+        if self._stack or self.loop_function is None:
             return '<LoopContext %d/%d%s>' % (
                 self.index,
                 self.length,
@@ -654,6 +671,20 @@ class TokenStream(object):
             self.next()
 
 
+class FlushMarker(unicode):
+    """
+    The empty string yielded by ``{% flush %}``. When rendering it's
+    joined like any other string, buffered streams yield their buffer
+    when they see it.
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'flush_marker'
+
+flush_marker = FlushMarker()
+
+
 class TemplateStream(object):
     """
     Wraps a genererator for outputing template streams.
@@ -671,12 +702,17 @@ class TemplateStream(object):
         self._next = self._gen.next
         self.buffered = False
 
-    def enable_buffering(self, size=5):
+    def enable_buffering(self, size=5, threshold=None):
         """
-        Enable buffering. Buffer `size` items before
-        yielding them.
+        Enable buffering. Buffer `size` items before yielding them. If
+        a `threshold` is given the buffer is yielded once it holds that
+        many characters instead, no matter how many items that are.
+        ``{% flush %}`` tags in the template yield the buffer early.
         """
-        if size <= 1:
+        if threshold is not None:
+            if threshold < 1:
+                raise ValueError('buffer threshold too small')
+        elif size <= 1:
             raise ValueError('buffer size too small')
         self.buffered = True
 
@@ -689,17 +725,45 @@ class TemplateStream(object):
             try:
                 while True:
                     item = next()
-                    if item:
+                    if item is flush_marker:
+                        if c_size:
+                            break
+                    elif item:
                         push(item)
                         c_size += 1
-                    if c_size >= size:
-                        raise StopIteration()
+                        if c_size >= size:
+                            break
+            except StopIteration:
+                if not c_size:
+                    raise
+            return u''.join(buf)
+
+        def threshold_next():
+            buf = []
+            c_size = 0
+            push = buf.append
+            next = self._gen.next
+
+            try:
+                while True:
+                    item = next()
+                    if item is flush_marker:
+                        if c_size:
+                            break
+                    elif item:
+                        push(item)
+                        c_size += len(item)
+                        if c_size >= threshold:
+                            break
             except StopIteration:
                 if not c_size:
                     raise
             return u''.join(buf)
 
-        self._next = buffering_next
+        if threshold is None:
+            self._next = buffering_next
+        else:
+            self._next = threshold_next
 
     def __iter__(self):
         return self
@@ -8,11 +8,15 @@
     :copyright: 2007 by Armin Ronacher.
     :license: BSD, see LICENSE for more details.
 """
+import sys
+from types import InstanceType
 from jinja.lexer import Lexer
 from jinja.parser import Parser
 from jinja.loaders import LoaderWrapper
-from jinja.datastructure import SilentUndefined, Markup, Context, FakeTranslator
-from jinja.utils import collect_translations, get_attribute
+from jinja.datastructure import SilentUndefined, Markup, TemplateData, \
+     Context, FakeTranslator
+from jinja.utils import collect_translations, get_attribute, \
+     check_attribute, escape
 from jinja.exceptions import FilterNotFound, TestNotFound, \
      SecurityException, TemplateSyntaxError
 from jinja.defaults import DEFAULT_FILTERS, DEFAULT_TESTS, DEFAULT_NAMESPACE
@@ -25,6 +29,31 @@ __all__ = ['Environment']
 _getattr = getattr
 
 
+#: types that are converted to unicode without any further checks. the
+#: unicode representation of those never contains characters that are
+#: escaped by the escape filter.
+_simple_types = set([int, long, float, bool])
+
+
+#: how `Environment.get_attribute` accesses attributes of a type
+_policy_item, _policy_attribute, _policy_blocked = range(3)
+
+#: the attribute access policies of that many ``(type, name)`` pairs are
+#: kept before the cache is cleared
+_max_policies = 2000
+
+
+def _deferred_error(exc_info):
+    """
+    Return a filter or test function that raises the exception from
+    `exc_info` when it's called.
+    """
+    exc_type, exc_value, tb = exc_info
+    def raise_error(env, context, value):
+        raise exc_type, exc_value, tb
+    return raise_error
+
+
 class Environment(object):
     """
     The Jinja environment.
@@ -54,7 +83,11 @@ class Environment(object):
                  undefined_singleton=SilentUndefined,
                  disable_regexps=False,
                  friendly_traceback=True,
-                 translator_factory=None):
+                 translator_factory=None,
+                 fragment_cache=None,
+                 flatten_inheritance=False,
+                 profiler=None,
+                 markup_cache=None):
         """
         Here the possible initialization parameters:
 
@@ -117,6 +150,33 @@ class Environment(object):
                                   the context as first argument to get the
                                   translator for the current instance.
                                   *new in Jinja 1.2*
+        `fragment_cache`          The backend that stores the output of
+                                  ``{% cache %}`` sections. See the
+                                  `jinja.cache` module for the available
+                                  backends. If this is `None` the sections
+                                  are rendered on every request.
+                                  *new in Jinja 1.2*
+        `flatten_inheritance`     If this is set to ``True`` ``super()``
+                                  calls in block bodies are resolved when
+                                  the template is compiled and blocks that
+                                  don't pass `super` around skip the
+                                  runtime lookup helper. Templates with
+                                  macros or call blocks that reference
+                                  `super` keep the runtime lookup.
+                                  *new in Jinja 1.2*
+        `profiler`                A `jinja.profiler.Profiler` that records
+                                  the render times of templates, blocks,
+                                  macros and includes. Templates are only
+                                  instrumented if the profiler is set
+                                  before they are compiled.
+                                  *new in Jinja 1.2*
+        `markup_cache`            A backend from `jinja.cache` that keeps the
+                                  output of the `markdown`, `rst` and
+                                  `textile` filters in addition to the
+                                  cache in the process, for example a
+                                  `FileSystemCache` so that the
+                                  conversions survive restarts.
+                                  *new in Jinja 1.2*
         ========================= ============================================
 
         All of these variables except those marked with a star (*) are
@@ -161,6 +221,22 @@ class Environment(object):
         # and here the translator factory
         self.translator_factory = translator_factory
 
+        # backend for {% cache %} sections
+        self.fragment_cache = fragment_cache
+
+        # resolve super() calls at compile time
+        self.flatten_inheritance = flatten_inheritance
+
+        # collects render times if set
+        self.profiler = profiler
+
+        # persistent cache for the markup filters
+        self.markup_cache = markup_cache
+
+        # attribute access policies for `get_attribute`
+        self._item_types = set()
+        self._attribute_policies = {}
+
         # create lexer
         self.lexer = Lexer(self)
 
@@ -225,6 +301,17 @@ class Environment(object):
         """
         Convert a value to unicode with the rules defined on the environment.
         """
+        # fast path for the common types
+        cls = value.__class__
+        if cls is unicode:
+            return value
+        elif cls in _simple_types:
+            return unicode(value)
+        elif cls is str:
+            try:
+                return unicode(value)
+            except UnicodeError:
+                return value.decode(self.charset, 'ignore')
         # undefined and None expand to ""
         if value in (None, self.undefined_singleton):
             return u''
@@ -238,6 +325,65 @@ class Environment(object):
         except UnicodeError:
             return str(value).decode(self.charset, 'ignore')
 
+    def make_finish_var(self):
+        """
+        Return a function that works like `finish_var` but looks up the
+        conversion for the type of the value in a table that is created
+        from the current settings, including auto escaping. The python
+        translator creates one for each loaded template.
+        """
+        to_unicode = self.to_unicode
+        default_filters = list(self.default_filters)
+        identity = lambda value, ctx: value
+        to_string = lambda value, ctx: unicode(value)
+        table = {self.undefined_singleton.__class__: to_string}
+        table[type(None)] = lambda value, ctx: u''
+
+        # no default filters. only convert to unicode
+        if not default_filters:
+            table.update({
+                unicode:        identity,
+                str:            lambda value, ctx: to_unicode(value),
+                Markup:         identity,
+                TemplateData:   identity
+            })
+
+        # the escape filter (auto_escape). escape in the same step
+        elif len(default_filters) == 1 and \
+             default_filters[0][0] == 'escape' and \
+             len(default_filters[0][1]) < 2 and \
+             self.filters.get('escape') is DEFAULT_FILTERS['escape']:
+            quote = default_filters[0][1] and default_filters[0][1][0]
+            table.update({
+                unicode:        lambda value, ctx: escape(value, quote),
+                str:            lambda value, ctx: escape(to_unicode(value),
+                                                          quote),
+                Markup:         to_string,
+                TemplateData:   identity
+            })
+
+        # other default filters
+        else:
+            apply_filters = self.apply_filters
+            def filtered(value, ctx):
+                return apply_filters(to_unicode(value), ctx, default_filters)
+            table.update({
+                unicode:        filtered,
+                str:            filtered,
+                Markup:         filtered,
+                TemplateData:   filtered
+            })
+            to_string = filtered
+
+        for cls in _simple_types:
+            table[cls] = to_string
+
+        get = table.get
+        finish_var = self.finish_var
+        def finish(value, ctx):
+            return get(value.__class__, finish_var)(value, ctx)
+        return finish
+
     def get_translator(self, context):
         """
         Return the translator for i18n.
@@ -286,6 +432,31 @@ class Environment(object):
             value = func(self, context, value)
         return value
 
+    def bind_filter(self, filtername, args):
+        """
+        Return the filter function for `filtername` and the arguments.
+        Used by the python translator to bind filters with constant
+        arguments once per template. Errors are raised when the filter
+        is applied, not when the template is loaded.
+        """
+        try:
+            if filtername not in self.filters:
+                raise FilterNotFound(filtername)
+            return self.filters[filtername](*args)
+        except Exception:
+            return _deferred_error(sys.exc_info())
+
+    def bind_test(self, testname, args):
+        """
+        Like `bind_filter` but for tests.
+        """
+        try:
+            if testname not in self.tests:
+                raise TestNotFound(testname)
+            return self.tests[testname](*args)
+        except Exception:
+            return _deferred_error(sys.exc_info())
+
     def perform_test(self, context, testname, args, value):
         """
         Perform a test on a variable.
@@ -304,15 +475,79 @@ class Environment(object):
             context.cache[key] = func = self.tests[testname](*args)
         return not not func(self, context, value)
 
+    def cache_fragment(self, key, timeout, render):
+        """
+        Return the cached output of a ``{% cache %}`` section. If the
+        fragment cache doesn't know the key yet `render` is called and
+        the result is stored for `timeout` seconds.
+        """
+        # some traceback systems allow to skip frames. but allow
+        # disabling that via -O to not make things slow
+        if __debug__:
+            __traceback_hide__ = True
+
+        cache = self.fragment_cache
+        if cache is None:
+            return render()
+        rv = cache.get(key)
+        if rv is None:
+            rv = render()
+            cache.set(key, rv, timeout)
+        return rv
+
     def get_attribute(self, obj, name):
         """
         Get one attribute from an object.
+
+        For types without item access the result of the security checks
+        is remembered per ``(type, name)`` so that attributes of those
+        objects are looked up directly. Instances of old-style classes
+        and objects with their own `jinja_allowed_attributes` are always
+        checked:
+
+        >>> class OldStyle:
+        ...     title = 'old'
+        >>> class Slotted(object):
+        ...     __slots__ = ('jinja_allowed_attributes', 'a', 'b')
+        ...     def __init__(self, allowed):
+        ...         self.jinja_allowed_attributes = allowed
+        ...         self.a = self.b = 42
+        >>> class Property(object):
+        ...     a = b = 42
+        ...     def __init__(self, allowed):
+        ...         self.allowed = allowed
+        ...     jinja_allowed_attributes = property(lambda x: x.allowed)
+        >>> env = Environment()
+        >>> env.get_attribute(OldStyle(), 'title')
+        'old'
+        >>> for cls in Slotted, Property:
+        ...     print env.get_attribute(cls(['a', 'b']), 'b'),
+        ...     print env.get_attribute(cls(['a']), 'b') is env.undefined_singleton
+        42 True
+        42 True
         """
         # some traceback systems allow to skip frames. but allow
         # disabling that via -O to not make things slow
         if __debug__:
             __traceback_hide__ = True
 
+        cls = obj.__class__
+        if type(obj) is cls and cls not in self._item_types and \
+           name.__class__ in (str, unicode) and \
+           _getattr(obj, 'jinja_allowed_attributes', None) is \
+           _getattr(cls, 'jinja_allowed_attributes', None):
+            key = (cls, name)
+            policy = self._attribute_policies.get(key)
+            if policy is None:
+                policy = self.get_attribute_policy(obj, name)
+            if policy is _policy_attribute:
+                try:
+                    return _getattr(obj, name)
+                except (AttributeError, UnicodeError):
+                    return self.undefined_singleton
+            elif policy is _policy_blocked:
+                return self.undefined_singleton
+
         try:
             return obj[name]
         except (TypeError, KeyError, IndexError, AttributeError):
@@ -324,6 +559,29 @@ class Environment(object):
             return _getattr(obj, name)
         return self.undefined_singleton
 
+    def get_attribute_policy(self, obj, name):
+        """
+        Find out how `get_attribute` can access the attribute `name` of
+        objects of the type of `obj` and remember it. `obj` must use the
+        `jinja_allowed_attributes` of its type.
+        """
+        cls = obj.__class__
+        if hasattr(cls, '__getitem__') or type(obj) is InstanceType or \
+           obj is self.undefined_singleton:
+            self._item_types.add(cls)
+            return _policy_item
+        try:
+            check_attribute(obj, name)
+        except (AttributeError, SecurityException):
+            policy = _policy_blocked
+        else:
+            policy = _policy_attribute
+        policies = self._attribute_policies
+        if len(policies) >= _max_policies:
+            policies.clear()
+        policies[(cls, name)] = policy
+        return policy
+
     def get_attributes(self, obj, attributes):
         """
         Get some attributes from an object. If attributes is an
@@ -9,17 +9,27 @@
     :license: BSD, see LICENSE for more details.
 """
 import re
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
 from random import choice
 from operator import itemgetter
 from urllib import urlencode, quote
+from threading import Lock
 from jinja.utils import urlize, escape, reversed, sorted, groupby, \
-     get_attribute, pformat
+     get_attribute, pformat, CacheDict
 from jinja.datastructure import TemplateData
 from jinja.exceptions import FilterArgumentError, SecurityException
 
 
 _striptags_re = re.compile(r'(<!--.*?-->|<[^>]*>)')
 
+#: output of the markup filters by digest of the input, limited to 200
+#: items and 4 million characters
+_markup_cache = CacheDict(200, 4 * 1024 * 1024, len)
+_markup_lock = Lock()
+
 
 def stringfilter(f):
     """
@@ -41,6 +51,48 @@ def stringfilter(f):
     return decorator
 
 
+def markupfilter(f, options=()):
+    """
+    Decorator for filters that convert markup to HTML. Like `stringfilter`
+    but the output is cached in the process and in the `markup_cache` of
+    the environment if there is one. The key is a digest of the input and
+    the `options` the converter is called with.
+    """
+    prefix = repr((f.__name__, options))
+    def decorator():
+        def wrapped(env, context, value):
+            value = env.to_unicode(value)
+            key = 'markup_%s' % sha1(prefix + value.encode('utf-8')) \
+                  .hexdigest()
+            _markup_lock.acquire()
+            try:
+                rv = _markup_cache.get(key)
+            finally:
+                _markup_lock.release()
+            if rv is not None:
+                return rv
+            store = env.markup_cache
+            if store is not None:
+                rv = store.get(key)
+            if rv is None:
+                rv = f(value)
+                if store is not None:
+                    store.set(key, rv)
+            _markup_lock.acquire()
+            try:
+                _markup_cache[key] = rv
+            finally:
+                _markup_lock.release()
+            return rv
+        return wrapped
+    try:
+        decorator.__doc__ = f.__doc__
+        decorator.__name__ = f.__name__
+    except:
+        pass
+    return decorator
+
+
 def simplefilter(f):
     """
     Decorator for simplifying filters. Filter arguments are passed
@@ -545,7 +597,7 @@ def do_textile(s):
     """
     from textile import textile
     return textile(s.encode('utf-8')).decode('utf-8')
-do_textile = stringfilter(do_textile)
+do_textile = markupfilter(do_textile)
 
 
 def do_markdown(s):
@@ -558,7 +610,7 @@ def do_markdown(s):
     """
     from markdown import markdown
     return markdown(s.encode('utf-8')).decode('utf-8')
-do_markdown = stringfilter(do_markdown)
+do_markdown = markupfilter(do_markdown)
 
 
 def do_rst(s):
@@ -573,7 +625,7 @@ def do_rst(s):
     from docutils.core import publish_parts
     parts = publish_parts(source=s, writer_name='html4css1')
     return parts['fragment']
-do_rst = stringfilter(do_rst)
+do_rst = markupfilter(do_rst, ('html4css1',))
 
 
 def do_int(default=0):
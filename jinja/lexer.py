@@ -24,6 +24,7 @@
 """
 import re
 import unicodedata
+from bisect import bisect_left
 from jinja.datastructure import TokenStream, Token
 from jinja.exceptions import TemplateSyntaxError
 from jinja.utils import set, sorted
@@ -39,12 +40,17 @@ _lexer_cache = WeakValueDictionary()
 
 
 # static regular expressions
-whitespace_re = re.compile(r'\s+(?um)')
-name_re = re.compile(r'[a-zA-Z_][a-zA-Z0-9_]*')
+#: the rules for tags share their flags so that `combine_rules` can
+#: compile them into one regular expression. that's why unicode
+#: whitespace is spelled out instead of using ``\s`` with re.U
+whitespace_re = re.compile(u'[%s]+(?ms)' % u''.join([re.escape(unichr(x))
+                           for x in xrange(0x10000) if unichr(x).isspace()]))
+name_re = re.compile(r'[a-zA-Z_][a-zA-Z0-9_]*(?ms)')
 string_re = re.compile(r"('([^'\\]*(?:\\.[^'\\]*)*)'"
                        r'|"([^"\\]*(?:\\.[^"\\]*)*)")(?ms)')
-integer_re = re.compile(r'\d+')
-float_re = re.compile(r'\d+\.\d+')
+integer_re = re.compile(r'[0-9]+(?ms)')
+float_re = re.compile(r'[0-9]+\.[0-9]+(?ms)')
+newline_re = re.compile(r'\n')
 regex_re = re.compile(r'@/([^/\\]*(?:\\.[^/\\]*)*)*/[a-z]*(?ms)')
 
 
@@ -88,7 +94,7 @@ operators = {
 
 reverse_operators = dict([(v, k) for k, v in operators.iteritems()])
 assert len(operators) == len(reverse_operators), 'operators dropped'
-operator_re = re.compile('(%s)' % '|'.join([re.escape(x) for x in
+operator_re = re.compile('(%s)(?ms)' % '|'.join([re.escape(x) for x in
                          sorted(operators, key=lambda x: -len(x))]))
 
 
@@ -191,6 +197,38 @@ class Failure(object):
         raise self.error_class(self.message, lineno, filename)
 
 
+def combine_rules(rules):
+    """
+    Compile the rules of a state into as few regular expressions as
+    possible so that most tokens are a single `match`. Each rule becomes
+    an alternative in a wrapping group; because alternatives are tried in
+    order this matches exactly what trying the rules one after another
+    would. Only consecutive rules with the same flags are combined.
+
+    Returns a list of ``(regex, groups)`` tuples that have to be tried in
+    order. `groups` maps the group number of every wrapping group to
+    ``(rule, names)`` where `names` are the named groups of the rule.
+    """
+    result = []
+    patterns = []
+    flags = None
+    for rule in rules:
+        regex = rule[0]
+        if regex.flags != flags:
+            if patterns:
+                result.append((re.compile('|'.join(patterns), flags), groups))
+            patterns = []
+            flags = regex.flags
+            groups = {}
+            offset = 1
+        patterns.append('(%s)' % regex.pattern)
+        groups[offset] = (rule, regex.groupindex.keys())
+        offset += regex.groups + 1
+    if patterns:
+        result.append((re.compile('|'.join(patterns), flags), groups))
+    return result
+
+
 class LexerMeta(type):
     """
     Metaclass for the lexer that caches instances for
@@ -329,6 +367,16 @@ class Lexer(object):
                 )), 'variable_end', '#pop')
             ] + tag_rules
 
+        # the combined regular expressions for `tokeniter`. the second
+        # one is used while braces are open and skips the end tag rules
+        self.combined = {}
+        for state, rules in self.rules.iteritems():
+            self.combined[state] = (
+                combine_rules(rules),
+                combine_rules([r for r in rules if r[1] not in
+                               ('variable_end', 'block_end')])
+            )
+
     def tokenize(self, source, filename=None):
         """
         Works like `tokeniter` but returns a tokenstream of tokens and not a
@@ -382,132 +430,134 @@ class Lexer(object):
         """
         source = '\n'.join(source.splitlines())
         pos = 0
-        lineno = 1
         stack = ['root']
-        statetokens = self.rules['root']
+        combined = self.combined['root']
         source_length = len(source)
 
+        # line numbers are looked up in a table of newline positions
+        newlines = [m.start() for m in newline_re.finditer(source)]
+
         balancing_stack = []
 
         while True:
-            # tokenizer loop
-            for regex, tokens, new_state in statetokens:
+            # tokenizer loop. we only match blocks and variables if
+            # braces / parentheses are balanced, otherwise the end tags
+            # are lexed by the operator rule.
+            m = None
+            for regex, groups in combined[bool(balancing_stack)]:
                 m = regex.match(source, pos)
-                # if no match we try again with the next rule
-                if not m:
-                    continue
+                if m is not None:
+                    break
 
-                # we only match blocks and variables if brances / parentheses
-                # are balanced. continue parsing with the lower rule which
-                # is the operator rule. do this only if the end tags look
-                # like operators
-                if balancing_stack and \
-                   tokens in ('variable_end', 'block_end'):
-                    continue
-
-                # tuples support more options
-                if isinstance(tokens, tuple):
-                    for idx, token in enumerate(tokens):
-                        # hidden group
-                        if token is None:
-                            g = m.group(idx)
-                            if g:
-                                lineno += g.count('\n')
-                            continue
-                        # failure group
-                        elif token.__class__ is Failure:
-                            raise token(lineno, filename)
-                        # bygroup is a bit more complex, in that case we
-                        # yield for the current token the first named
-                        # group that matched
-                        elif token == '#bygroup':
-                            for key, value in m.groupdict().iteritems():
-                                if value is not None:
-                                    yield lineno, key, value
-                                    lineno += value.count('\n')
-                                    break
-                            else:
-                                raise RuntimeError('%r wanted to resolve '
-                                                   'the token dynamically'
-                                                   ' but no group matched'
-                                                   % regex)
-                        # normal group
-                        else:
-                            data = m.group(idx + 1)
-                            if data:
-                                yield lineno, token, data
-                            lineno += data.count('\n')
-
-                # strings as token just are yielded as it, but just
-                # if the data is not empty
-                else:
-                    data = m.group()
-                    # update brace/parentheses balance
-                    if tokens == 'operator':
-                        if data == '{':
-                            balancing_stack.append('}')
-                        elif data == '(':
-                            balancing_stack.append(')')
-                        elif data == '[':
-                            balancing_stack.append(']')
-                        elif data in ('}', ')', ']'):
-                            if not balancing_stack:
-                                raise TemplateSyntaxError('unexpected "%s"' %
-                                                          data, lineno,
-                                                          filename)
-                            expected_op = balancing_stack.pop()
-                            if expected_op != data:
-                                raise TemplateSyntaxError('unexpected "%s", '
-                                                          'expected "%s"' %
-                                                          (data, expected_op),
-                                                          lineno, filename)
-                    # yield items
-                    if tokens is not None:
-                        if data:
-                            yield lineno, tokens, data
-                    lineno += data.count('\n')
-
-                # fetch new position into new variable so that we can check
-                # if there is a internal parsing error which would result
-                # in an infinite loop
-                pos2 = m.end()
-
-                # handle state changes
-                if new_state is not None:
-                    # remove the uppermost state
-                    if new_state == '#pop':
-                        stack.pop()
-                    # resolve the new state by group checking
-                    elif new_state == '#bygroup':
-                        for key, value in m.groupdict().iteritems():
-                            if value is not None:
-                                stack.append(key)
-                                break
-                        else:
-                            raise RuntimeError('%r wanted to resolve the '
-                                               'new state dynamically but'
-                                               ' no group matched' %
-                                               regex)
-                    # direct state name given
-                    else:
-                        stack.append(new_state)
-                    statetokens = self.rules[stack[-1]]
-                # we are still at the same position and no stack change.
-                # this means a loop without break condition, avoid that and
-                # raise error
-                elif pos2 == pos:
-                    raise RuntimeError('%r yielded empty string without '
-                                       'stack change' % regex)
-                # publish new function and start again
-                pos = pos2
-                break
-            # if loop terminated without break we havn't found a single match
-            # either we are at the end of the file or we have a problem
-            else:
+            # no match means that either we are at the end of the file
+            # or we have a problem
+            if m is None:
                 # end of text
                 if pos >= source_length:
                     return
                 # something went wrong
                 raise TemplateSyntaxError('unexpected char %r at %d' %
-                                          (source[pos], pos), lineno,
-                                          filename)
+                                          (source[pos], pos),
+                                          bisect_left(newlines, pos) + 1, filename)
+
+            # the wrapping group of the matched rule closes last
+            base = m.lastindex
+            (rule_regex, tokens, new_state), names = groups[base]
+
+            # tokens of None are skipped (whitespace in tags)
+            if tokens is None:
+                pass
+
+            # tuples support more options
+            elif tokens.__class__ is tuple:
+                for idx, token in enumerate(tokens):
+                    # hidden group
+                    if token is None:
+                        continue
+                    # failure group
+                    elif token.__class__ is Failure:
+                        raise token(bisect_left(newlines, pos) + 1, filename)
+                    # bygroup is a bit more complex, in that case we
+                    # yield for the current token the first named
+                    # group that matched
+                    elif token == '#bygroup':
+                        for key in names:
+                            value = m.group(key)
+                            if value is not None:
+                                yield bisect_left(newlines, m.start(key)) + 1, \
+                                      key, value
+                                break
+                        else:
+                            raise RuntimeError('%r wanted to resolve '
+                                               'the token dynamically'
+                                               ' but no group matched'
+                                               % rule_regex)
+                    # normal group
+                    else:
+                        data = m.group(base + idx + 1)
+                        if data:
+                            yield bisect_left(newlines, m.start(base + idx +
+                                                            1)) + 1, \
+                                  token, data
+
+            # strings as token just are yielded as it, but just
+            # if the data is not empty
+            else:
+                data = m.group()
+                # update brace/parentheses balance
+                if tokens == 'operator':
+                    if data == '{':
+                        balancing_stack.append('}')
+                    elif data == '(':
+                        balancing_stack.append(')')
+                    elif data == '[':
+                        balancing_stack.append(']')
+                    elif data in ('}', ')', ']'):
+                        if not balancing_stack:
+                            raise TemplateSyntaxError('unexpected "%s"' %
+                                                      data, bisect_left(newlines, pos) + 1,
+                                                      filename)
+                        expected_op = balancing_stack.pop()
+                        if expected_op != data:
+                            raise TemplateSyntaxError('unexpected "%s", '
+                                                      'expected "%s"' %
+                                                      (data, expected_op),
+                                                      bisect_left(newlines, pos) + 1,
+                                                      filename)
+                # yield items
+                if data:
+                    yield bisect_left(newlines, pos) + 1, tokens, data
+
+            # fetch new position into new variable so that we can check
+            # if there is a internal parsing error which would result
+            # in an infinite loop
+            pos2 = m.end()
+
+            # handle state changes
+            if new_state is not None:
+                # remove the uppermost state
+                if new_state == '#pop':
+                    stack.pop()
+                # resolve the new state by group checking
+                elif new_state == '#bygroup':
+                    for key in names:
+                        if m.group(key) is not None:
+                            stack.append(key)
+                            break
+                    else:
+                        raise RuntimeError('%r wanted to resolve the '
+                                           'new state dynamically but'
+                                           ' no group matched' %
+                                           rule_regex)
+                # direct state name given
+                else:
+                    stack.append(new_state)
+                combined = self.combined[stack[-1]]
+            # we are still at the same position and no stack change.
+            # this means a loop without break condition, avoid that and
+            # raise error
+            elif pos2 == pos:
+                raise RuntimeError('%r yielded empty string without '
+                                   'stack change' % rule_regex)
+            # publish new function and start again
+            pos = pos2
@@ -9,16 +9,20 @@
     :license: BSD, see LICENSE for more details.
 """
 
+import os
+import sys
 import codecs
+import tempfile
 try:
     from hashlib import sha1
 except ImportError:
     from sha import new as sha1
-import time
 from os import path
-from threading import Lock
+from threading import Lock, Event
+from thread import get_ident
 from jinja.parser import Parser
 from jinja.translators.python import PythonTranslator, Template
+from jinja.bundle import TemplateBundle
 from jinja.exceptions import TemplateNotFound, TemplateSyntaxError, \
      TemplateIncludeError
 from jinja.utils import CacheDict
@@ -46,6 +50,98 @@ def get_cachename(cachepath, name, salt=None):
                           (name, salt or '')).hexdigest())
 
 
+def dump_template(tmpl, filename):
+    """
+    Write the bytecode of a template into a file. The file is replaced
+    atomically so that other processes never load half written files.
+    """
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=path.dirname(filename))
+    f = os.fdopen(fd, 'wb')
+    try:
+        tmpl.dump(f)
+    finally:
+        f.close()
+    try:
+        os.rename(tmp, filename)
+    except OSError:
+        # windows doesn't replace existing files on rename
+        try:
+            os.remove(filename)
+            os.rename(tmp, filename)
+        except OSError:
+            os.remove(tmp)
+
+
+class _Flight(object):
+    """
+    A template that is loaded by one thread and waited for by others.
+    """
+
+    def __init__(self):
+        self.owner = get_ident()
+        self.event = Event()
+        self.result = None
+        self.exc_info = None
+
+    def finish(self, result):
+        self.result = result
+        self.event.set()
+
+    def fail(self, exc_info):
+        self.exc_info = exc_info
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+def load_once(flights, lock, name, lookup, func, *args):
+    """
+    Call `func` with `args` to load the template `name` unless another
+    thread is loading it already, in that case wait for its result.
+    `flights` is a dict of the running loads protected by `lock`.
+
+    A thread that missed the cache just before the previous load
+    finished would load the template a second time, so once a thread
+    registered its load it calls `lookup` with `args` to check the cache
+    again. That load put its result into the cache before it was
+    unregistered, so `lookup` finds it.
+    """
+    lock.acquire()
+    try:
+        flight = flights.get(name)
+        if flight is None or flight.owner == get_ident():
+            flight = flights[name] = _Flight()
+            leader = True
+        else:
+            leader = False
+    finally:
+        lock.release()
+    if not leader:
+        return flight.wait()
+
+    try:
+        try:
+            rv = lookup(*args)
+            if rv is None:
+                rv = func(*args)
+        except:
+            flight.fail(sys.exc_info())
+            raise
+        flight.finish(rv)
+        return rv
+    finally:
+        lock.acquire()
+        try:
+            if flights.get(name) is flight:
+                del flights[name]
+        finally:
+            lock.release()
+
+
 def _loader_missing(*args, **kwargs):
     """Helper function for `LoaderWrapper`."""
     raise RuntimeError('no loader defined')
@@ -199,6 +295,10 @@ class CachedLoaderMixin(object):
     If the memcaching is enabled you can use (with Jinja 1.1 onwards)
     the `clear_memcache` function to clear the cache.
 
+    If auto reloading is enabled a cached template is not only reloaded
+    if its own source changed but also if one of the templates it extends
+    or includes changed (directly or through other templates).
+
     For memcached support check the `MemcachedLoaderMixin`.
     """
 
@@ -214,7 +314,8 @@ class CachedLoaderMixin(object):
         else:
             self.__auto_reload = auto_reload
         self.__salt = cache_salt
-        self.__times = {}
+        self.__versions = {}
+        self.__flights = {}
         self.__lock = Lock()
 
     def clear_memcache(self):
@@ -222,7 +323,20 @@ class CachedLoaderMixin(object):
         Clears the memcache.
         """
         if self.__memcache is not None:
-            self.__memcache.clear()
+            self.__lock.acquire()
+            try:
+                self.__memcache.clear()
+                self.__versions.clear()
+            finally:
+                self.__lock.release()
+
+    def get_dependency_versions(self, environment, tmpl):
+        """
+        Return a list of ``(name, version)`` tuples for all templates
+        `tmpl` was compiled from except the template itself.
+        """
+        return [(name, self.check_source_changed(environment, name))
+                for name in tmpl.dependencies]
 
     def load(self, environment, name, translator):
         """
@@ -231,83 +345,109 @@ class CachedLoaderMixin(object):
         not the cache check for a compiled template in the disk cache
         folder. And if none of this is the case we translate the temlate,
         cache and return it.
+
+        If a template is requested by more than one thread while it's not
+        cached only the first thread loads it, the others wait for the
+        result.
+        """
+        # caching is only possible for the python translator. skip
+        # all other translators
+        if translator is not PythonTranslator:
+            return super(CachedLoaderMixin, self).load(
+                         environment, name, translator)
+
+        # auto reload enabled? check for the last change of
+        # the template
+        if self.__auto_reload:
+            last_change = self.check_source_changed(environment, name)
+        else:
+            last_change = None
+
+        tmpl = self.__lookup(environment, name, translator, last_change)
+        if tmpl is not None:
+            return tmpl
+        return load_once(self.__flights, self.__lock, name, self.__lookup,
+                         self.__load, environment, name, translator,
+                         last_change)
+
+    def __lookup(self, environment, name, translator, last_change):
+        """
+        Helper for `load` that returns the template from the memory cache
+        or `None` if it's not there or outdated.
         """
+        # check if we have something in the memory cache and the
+        # memory cache is enabled.
+        if self.__memcache is None:
+            return None
         self.__lock.acquire()
         try:
-            # caching is only possible for the python translator. skip
-            # all other translators
-            if translator is not PythonTranslator:
-                return super(CachedLoaderMixin, self).load(
-                             environment, name, translator)
-
-            tmpl = None
-            save_to_disk = False
-            push_to_memory = False
+            tmpl = self.__memcache.get(name)
+            versions = self.__versions.get(name)
+        finally:
+            self.__lock.release()
+        if tmpl is not None:
+            # if auto reload is enabled check if the template or
+            # one of its dependencies changed
+            if last_change is None or (versions[0] == last_change and
+               versions[1] == self.get_dependency_versions(environment,
+                                                           tmpl)):
+                return tmpl
+
+    def __load(self, environment, name, translator, last_change):
+        """
+        Helper for `load` that loads a template from the disk cache or
+        translates it and updates the caches.
+        """
+        tmpl = None
+        save_to_disk = False
 
-            # auto reload enabled? check for the last change of
-            # the template
-            if self.__auto_reload:
-                last_change = self.check_source_changed(environment, name)
+        # mem cache disabled or not cached by now
+        # try to load if from the disk cache
+        if self.__cache_folder is not None:
+            cache_fn = get_cachename(self.__cache_folder, name, self.__salt)
+            try:
+                f = file(cache_fn, 'rb')
+            except IOError:
+                save_to_disk = True
             else:
-                last_change = None
-
-            # check if we have something in the memory cache and the
-            # memory cache is enabled.
-            if self.__memcache is not None:
-                if name in self.__memcache:
-                    tmpl = self.__memcache[name]
-                    # if auto reload is enabled check if the template changed
-                    if last_change and last_change > self.__times[name]:
-                        tmpl = None
-                        push_to_memory = True
-                else:
-                    push_to_memory = True
-
-            # mem cache disabled or not cached by now
-            # try to load if from the disk cache
-            if tmpl is None and self.__cache_folder is not None:
-                cache_fn = get_cachename(self.__cache_folder, name, self.__salt)
-                if last_change is not None:
-                    try:
-                        cache_time = path.getmtime(cache_fn)
-                    except OSError:
-                        cache_time = 0
-                if last_change is None or (cache_time and
-                   last_change <= cache_time):
-                    try:
-                        f = file(cache_fn, 'rb')
-                    except IOError:
-                        tmpl = None
-                        save_to_disk = True
-                    else:
-                        try:
-                            tmpl = Template.load(environment, f)
-                        finally:
-                            f.close()
-                else:
-                    save_to_disk = True
-
-            # if we still have no template we load, parse and translate it.
-            if tmpl is None:
-                tmpl = super(CachedLoaderMixin, self).load(
-                             environment, name, translator)
-
-            # save the compiled template on the disk if enabled
-            if save_to_disk:
-                f = file(cache_fn, 'wb')
                 try:
-                    tmpl.dump(f)
+                    tmpl = Template.load(environment, f)
                 finally:
                     f.close()
-
-            # if memcaching is enabled and the template not loaded
-            # we add that there.
-            if push_to_memory:
-                self.__times[name] = time.time()
+                # the cached template is outdated if the template or
+                # one of its dependencies changed after it was written
+                if last_change is not None:
+                    cache_time = path.getmtime(cache_fn)
+                    for dependency, version in [(name, last_change)] + \
+                            self.get_dependency_versions(environment, tmpl):
+                        if version > cache_time:
+                            tmpl = None
+                            save_to_disk = True
+                            break
+
+        # if we still have no template we load, parse and translate it.
+        if tmpl is None:
+            tmpl = super(CachedLoaderMixin, self).load(
+                         environment, name, translator)
+
+        # save the compiled template on the disk if enabled
+        if save_to_disk:
+            dump_template(tmpl, cache_fn)
+
+        # if memcaching is enabled and the template not loaded
+        # we add that there.
+        if self.__memcache is not None:
+            if last_change is not None:
+                versions = (last_change,
+                            self.get_dependency_versions(environment, tmpl))
+            self.__lock.acquire()
+            try:
+                if last_change is not None:
+                    self.__versions[name] = versions
                 self.__memcache[name] = tmpl
-            return tmpl
-        finally:
-            self.__lock.release()
+            finally:
+                self.__lock.release()
+        return tmpl
 
 
 class MemcachedLoaderMixin(object):
@@ -390,6 +530,241 @@ class MemcachedLoaderMixin(object):
             self.__lock.release()
 
 
+class TieredLoaderMixin(object):
+    """
+    Caches templates in two tiers: an in-process LRU cache of template
+    objects in front of a store for the bytecode that is shared between
+    processes. The store can be any fragment cache backend from
+    `jinja.cache`, for example a `FileSystemCache` for a local directory,
+    a `SqliteCache` or a `MemcachedCache`:
+
+    .. sourcecode:: python
+
+        from jinja.cache import SqliteCache
+        from jinja.loaders import TieredLoaderMixin, BaseFileSystemLoader
+
+        class MyLoader(TieredLoaderMixin, BaseFileSystemLoader):
+
+            def __init__(self, searchpath):
+                BaseFileSystemLoader.__init__(self, searchpath)
+                TieredLoaderMixin.__init__(self, SqliteCache('/tmp/t.db'))
+
+    Templates found in the process cache are returned without asking the
+    store. New processes load the bytecode from the store so that only
+    one of them compiles a template.
+
+    If the class provides a `check_source_changed` method and
+    `auto_reload` is enabled, templates are reloaded if they or one of
+    the templates they extend or include changed. In that case every
+    load calls `check_source_changed` for those templates.
+    """
+
+    def __init__(self, store, cache_size=40, auto_reload=True,
+                 cache_salt=None, store_timeout=None):
+        self.__memcache = CacheDict(cache_size)
+        self.__store = store
+        self.__store_timeout = store_timeout
+        if not hasattr(self, 'check_source_changed'):
+            self.__auto_reload = False
+        else:
+            self.__auto_reload = auto_reload
+        self.__salt = cache_salt
+        self.__versions = {}
+        self.__flights = {}
+        self.__lock = Lock()
+
+    def clear_memcache(self):
+        """
+        Clears the in-process cache. The store is not affected.
+        """
+        self.__lock.acquire()
+        try:
+            self.__memcache.clear()
+            self.__versions.clear()
+        finally:
+            self.__lock.release()
+
+    def get_store_key(self, name):
+        """
+        Return the key for the bytecode of a template in the store.
+        """
+        return 'jinja_template(%s|%s)' % (name, self.__salt or '')
+
+    def get_dependency_versions(self, environment, tmpl):
+        """
+        Return a list of ``(name, version)`` tuples for all templates
+        `tmpl` was compiled from except the template itself.
+        """
+        return [(name, self.check_source_changed(environment, name))
+                for name in tmpl.dependencies]
+
+    def load(self, environment, name, translator):
+        """
+        Return the template from the process cache, the store or load
+        and translate it, in that order.
+        """
+        # caching is only possible for the python translator. skip
+        # all other translators
+        if translator is not PythonTranslator:
+            return super(TieredLoaderMixin, self).load(
+                         environment, name, translator)
+
+        if self.__auto_reload:
+            last_change = self.check_source_changed(environment, name)
+        else:
+            last_change = None
+
+        tmpl = self.__lookup(environment, name, translator, last_change)
+        if tmpl is not None:
+            return tmpl
+        return load_once(self.__flights, self.__lock, name, self.__lookup,
+                         self.__load, environment, name, translator,
+                         last_change)
+
+    def __lookup(self, environment, name, translator, last_change):
+        """
+        Helper for `load` that returns the template from the process
+        cache or `None` if it's not there or outdated.
+        """
+        self.__lock.acquire()
+        try:
+            tmpl = self.__memcache.get(name)
+            versions = self.__versions.get(name)
+        finally:
+            self.__lock.release()
+        if tmpl is not None and (last_change is None or versions ==
+           (last_change, self.get_dependency_versions(environment, tmpl))):
+            return tmpl
+
+    def __load(self, environment, name, translator, last_change):
+        """
+        Helper for `load` that loads a template from the store or
+        translates it and updates both tiers.
+        """
+        tmpl = None
+        key = self.get_store_key(name)
+
+        # the store holds the versions the bytecode was compiled from
+        item = self.__store.get(key)
+        if item is not None:
+            version, dependencies, bytecode = item
+            tmpl = Template.load(environment, bytecode)
+            dependencies = list(dependencies)
+            if last_change is not None and (version != last_change or
+               dependencies != self.get_dependency_versions(environment,
+                                                            tmpl)):
+                tmpl = None
+
+        if tmpl is None:
+            tmpl = super(TieredLoaderMixin, self).load(
+                         environment, name, translator)
+            if last_change is not None:
+                dependencies = self.get_dependency_versions(environment,
+                                                            tmpl)
+            else:
+                dependencies = []
+            self.__store.set(key, (last_change, tuple(dependencies),
+                                   tmpl.dump()), self.__store_timeout)
+
+        self.__lock.acquire()
+        try:
+            self.__versions[name] = (last_change, dependencies)
+            self.__memcache[name] = tmpl
+        finally:
+            self.__lock.release()
+        return tmpl
+
+
+class BundleLoaderMixin(object):
+    """
+    Serves templates from a bundle of precompiled templates (see
+    `jinja.bundle`) and only compiles templates missing in the bundle.
+
+    Subclasses have to implement `get_source_versions` which returns a
+    dict of all template names and their current versions. Entries in the
+    bundle are looked up by the version of the template (for example the
+    hash of its source) and only used if the templates it extends or
+    includes have still the same versions. If finding out the versions is
+    expensive subclasses should implement `get_versions_key` too.
+
+    `bundle` can be a `TemplateBundle`, the filename of a bundle or
+    `None` to disable the bundle.
+    """
+
+    def __init__(self, bundle=None):
+        if isinstance(bundle, basestring):
+            bundle = TemplateBundle(bundle)
+        self.bundle = bundle
+        self.__versions = None
+
+    def get_source_versions(self, environment):
+        """
+        Return a dict with the current versions of all templates.
+        """
+        raise NotImplementedError()
+
+    def get_versions_key(self, environment):
+        """
+        Return a cheap value that changes whenever the versions of the
+        templates may have changed. As long as it stays the same the
+        versions are not asked for again. The default implementation
+        returns `None` which means that `get_source_versions` is called
+        for every template that is loaded.
+        """
+        return None
+
+    def get_current_versions(self, environment):
+        """
+        Return the versions of all templates, from the cache if the
+        `get_versions_key` didn't change.
+        """
+        key = self.get_versions_key(environment)
+        if key is not None:
+            cached = self.__versions
+            if cached is not None and cached[0] == key:
+                return cached[1]
+        versions = self.get_source_versions(environment)
+        if key is not None:
+            self.__versions = (key, versions)
+        return versions
+
+    def translate(self, environment, name):
+        """
+        Load and translate a template without looking at the bundle.
+        """
+        return super(BundleLoaderMixin, self).load(environment, name,
+                                                   PythonTranslator)
+
+    def get_bundle_entry(self, environment, name, tmpl, versions):
+        """
+        Return the ``(key, template, versions)`` tuple for `write_bundle`
+        for a template compiled by this loader. `versions` is the dict
+        returned by `get_source_versions`.
+        """
+        return (versions[name], tmpl, [(dependency, versions.get(dependency))
+                                       for dependency in tmpl.dependencies])
+
+    def load(self, environment, name, translator):
+        """
+        Return the template from the bundle if it's up to date, otherwise
+        load and translate it.
+        """
+        if translator is PythonTranslator and self.bundle is not None:
+            versions = self.get_current_versions(environment)
+            key = versions.get(name)
+            if key is not None:
+                rv = self.bundle.get(environment, key)
+                if rv is not None:
+                    tmpl, dependencies = rv
+                    for dependency, version in dependencies:
+                        if versions.get(dependency) != version:
+                            break
+                    else:
+                        return tmpl
+        return super(BundleLoaderMixin, self).load(environment, name,
+                                                   translator)
+
+
 class BaseFileSystemLoader(BaseLoader):
     """
     Baseclass for the file system loader that does not do any caching.
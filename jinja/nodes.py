@@ -199,6 +199,18 @@ class Print(Node):
         return 'Print(%r)' % (self.expr,)
 
 
+class Flush(Node):
+    """
+    A node that represents a flush tag.
+    """
+
+    def get_items(self):
+        return []
+
+    def __repr__(self):
+        return 'Flush()'
+
+
 class Macro(Node):
     """
     A node that represents a macro.
@@ -283,6 +295,28 @@ class Filter(Node):
         )
 
 
+class Cache(Node):
+    """
+    Node for fragment caching sections.
+    """
+
+    def __init__(self, key, timeout, body, lineno=None, filename=None):
+        Node.__init__(self, lineno, filename)
+        self.key = key
+        self.timeout = timeout
+        self.body = body
+
+    def get_items(self):
+        return [self.key, self.timeout, self.body]
+
+    def __repr__(self):
+        return 'Cache(%r, %r, %r)' % (
+            self.key,
+            self.timeout,
+            self.body
+        )
+
+
 class Block(Node):
     """
     A node that represents a block.
@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja.optimizer
+    ~~~~~~~~~~~~~~~
+
+    This module implements an optimisation pass over the jinja ast that
+    runs before the translator. It does the work the generated code would
+    otherwise repeat on every render:
+
+    - constant arithmetic, comparisons, concatenation and conditional
+      expressions are folded
+    - pure filters from the default filter set are applied to constants
+    - constant variables are rendered into the static text
+    - branches of if conditions with constant tests are resolved
+    - adjacent static text and variable tags are merged so that they
+      end up in one ``yield``
+
+    :copyright: 2007 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+import re
+from operator import add, sub, mul, truediv, floordiv, mod, pow, \
+     eq, ne, lt, le, gt, ge
+from jinja import nodes
+from jinja.defaults import DEFAULT_FILTERS
+
+
+#: filters without side effects that don't look at the context. They are
+#: only applied at compile time if the environment uses the default
+#: implementation.
+PURE_FILTERS = set(['replace', 'upper', 'lower', 'escape', 'e',
+                    'capitalize', 'title', 'center', 'indent', 'truncate',
+                    'wordwrap', 'wordcount', 'count', 'length', 'int',
+                    'float', 'string', 'format', 'trim', 'striptags',
+                    'abs', 'round', 'filesizeformat', 'urlencode'])
+
+#: the types the folder creates constants for
+_constant_types = (unicode, str, int, long, float, bool, type(None))
+
+#: folded strings are not allowed to get any longer than this
+_max_length = 1024
+
+#: splits the format string of a text node into the static parts
+_text_re = re.compile(r'((?:[^%]|%%)*)%s')
+
+#: the attributes of the nodes that can hold other nodes. Nodes that are
+#: not listed here are searched completely.
+_child_fields = {
+    nodes.Template:                 ('body',),
+    nodes.Text:                     ('variables',),
+    nodes.ForLoop:                  ('seq', 'body', 'else_'),
+    nodes.IfCondition:              ('tests', 'else_'),
+    nodes.Cycle:                    ('seq',),
+    nodes.Print:                    ('expr',),
+    nodes.Macro:                    ('arguments', 'body'),
+    nodes.Call:                     ('expr', 'body'),
+    nodes.Set:                      ('expr',),
+    nodes.Filter:                   ('body', 'filters'),
+    nodes.Cache:                    ('key', 'timeout', 'body'),
+    nodes.Flush:                    (),
+    nodes.Block:                    ('body',),
+    nodes.Include:                  (),
+    nodes.Trans:                    ('replacements',),
+    nodes.ConstantExpression:       (),
+    nodes.UndefinedExpression:      (),
+    nodes.RegexExpression:          (),
+    nodes.NameExpression:           (),
+    nodes.ListExpression:           ('items',),
+    nodes.DictExpression:           ('items',),
+    nodes.SetExpression:            ('items',),
+    nodes.TupleExpression:          ('items',),
+    nodes.ConditionalExpression:    ('test', 'expr1', 'expr2'),
+    nodes.FilterExpression:         ('node', 'filters'),
+    nodes.TestExpression:           ('node', 'args'),
+    nodes.CallExpression:           ('node', 'args', 'kwargs', 'dyn_args',
+                                     'dyn_kwargs'),
+    nodes.SubscriptExpression:      ('node', 'arg'),
+    nodes.SliceExpression:          ('start', 'stop', 'step'),
+    nodes.ConcatExpression:         ('args',),
+    nodes.CompareExpression:        ('expr', 'ops'),
+    nodes.NotExpression:            ('node',),
+    nodes.NegExpression:            ('node',),
+    nodes.PosExpression:            ('node',)
+}
+
+_binary_operators = {
+    nodes.AddExpression:        add,
+    nodes.SubExpression:        sub,
+    nodes.MulExpression:        mul,
+    nodes.DivExpression:        truediv,
+    nodes.FloorDivExpression:   floordiv,
+    nodes.ModExpression:        mod,
+    nodes.PowExpression:        pow
+}
+_child_fields.update(dict.fromkeys(_binary_operators.keys() +
+                                   [nodes.AndExpression, nodes.OrExpression],
+                                   ('left', 'right')))
+
+_compare_operators = {
+    'eq':       eq,
+    'ne':       ne,
+    'lt':       lt,
+    'lteq':     le,
+    'gt':       gt,
+    'gteq':     ge,
+    'in':       lambda a, b: a in b,
+    'not in':   lambda a, b: a not in b
+}
+
+
+class CannotFold(Exception):
+    """
+    Raised if an expression can't be evaluated at compile time.
+    """
+
+
+def is_constant(node):
+    """
+    Check if a node is a constant the folder can work with.
+    """
+    return node.__class__ is nodes.ConstantExpression and \
+           node.value.__class__ in _constant_types
+
+
+def make_constant(value, node):
+    """
+    Return a constant node for `value` with the position of `node`.
+    """
+    if value.__class__ not in _constant_types:
+        raise CannotFold()
+    # inf and nan have no literal
+    if value.__class__ is float and (value != value or
+                                     value in (1e1000, -1e1000)):
+        raise CannotFold()
+    if isinstance(value, basestring) and len(value) > _max_length:
+        raise CannotFold()
+    return nodes.ConstantExpression(value, node.lineno, node.filename)
+
+
+class Optimizer(object):
+    """
+    Folds constants and merges static data in a node tree. The nodes are
+    modified in place.
+    """
+
+    def __init__(self, environment):
+        self.environment = environment
+        self.handlers = {
+            nodes.NodeList:                 self.optimize_node_list,
+            nodes.Text:                     self.optimize_text,
+            nodes.Print:                    self.optimize_print,
+            nodes.IfCondition:              self.optimize_if_condition,
+            nodes.ConcatExpression:         self.optimize_concat,
+            nodes.CompareExpression:        self.optimize_compare,
+            nodes.FilterExpression:         self.optimize_filter_expr,
+            nodes.ConditionalExpression:    self.optimize_conditional_expr,
+            nodes.AndExpression:            self.optimize_and,
+            nodes.OrExpression:             self.optimize_or,
+            nodes.NotExpression:            self.optimize_not,
+            nodes.NegExpression:            self.optimize_neg,
+            nodes.PosExpression:            self.optimize_pos
+        }
+        for cls in _binary_operators:
+            self.handlers[cls] = self.optimize_binary
+
+    def optimize(self, node):
+        """
+        Optimize a node and return it or the node that replaces it.
+        """
+        if node is None:
+            return node
+        self.optimize_children(node)
+        handler = self.handlers.get(node.__class__)
+        if handler is None:
+            return node
+        try:
+            return handler(node)
+        except CannotFold:
+            return node
+
+    def optimize_children(self, node):
+        """
+        Optimize all nodes that are stored on a node. Child nodes can
+        be stored in lists, tuples and dicts too.
+        """
+        if node.__class__ is nodes.NodeList:
+            node[:] = [self.optimize(n) for n in node]
+            return
+        fields = _child_fields.get(node.__class__)
+        if fields is None:
+            fields = node.__dict__.keys()
+        for key in fields:
+            value = getattr(node, key)
+            if value is not None:
+                setattr(node, key, self.optimize_value(value))
+
+    def optimize_value(self, value):
+        """Helper for `optimize_children`."""
+        if isinstance(value, nodes.Node):
+            return self.optimize(value)
+        elif value.__class__ is list:
+            return [self.optimize_value(x) for x in value]
+        elif value.__class__ is tuple:
+            return tuple([self.optimize_value(x) for x in value])
+        elif value.__class__ is dict:
+            return dict([(k, self.optimize_value(v)) for k, v
+                         in value.iteritems()])
+        return value
+
+    def get_filter(self, name, args):
+        """
+        Return the filter function for a pure filter or raise
+        `CannotFold` for all other filters.
+        """
+        if name not in PURE_FILTERS:
+            raise CannotFold()
+        factory = self.environment.filters.get(name)
+        if factory is None or factory is not DEFAULT_FILTERS.get(name):
+            raise CannotFold()
+        try:
+            return factory(*args)
+        except Exception:
+            raise CannotFold()
+
+    def apply_filter(self, func, value):
+        """
+        Apply a filter function to a value at compile time.
+        """
+        try:
+            return func(self.environment, None, value)
+        except Exception:
+            raise CannotFold()
+
+    def render_constant(self, value):
+        """
+        Return the output of a constant variable tag the same way
+        `Environment.finish_var` would do it.
+        """
+        if value is None:
+            return u''
+        value = self.environment.to_unicode(value)
+        for name, args in self.environment.default_filters:
+            value = self.apply_filter(self.get_filter(name, args), value)
+        if value.__class__ is not unicode:
+            raise CannotFold()
+        return value
+
+    # -- statements
+
+    def optimize_node_list(self, node):
+        """
+        Splice nested node lists that don't need a scope of their own
+        and merge adjacent text nodes.
+        """
+        children = []
+        for child in node:
+            if child.__class__ is nodes.NodeList:
+                children.extend(child)
+            else:
+                children.append(child)
+        result = []
+        for child in children:
+            if child.__class__ is nodes.Text and not \
+                 (child.text or child.variables):
+                continue
+            elif child.__class__ is nodes.Text and result and \
+                 result[-1].__class__ is nodes.Text:
+                last = result[-1]
+                result[-1] = nodes.Text(last.text + child.text,
+                                        list(last.variables) +
+                                        list(child.variables),
+                                        last.lineno, last.filename)
+            else:
+                result.append(child)
+        node[:] = result
+        return node
+
+    def optimize_text(self, node):
+        """
+        Render constant variables into the static text.
+        """
+        if not node.variables:
+            return node
+        text = []
+        variables = []
+        pos = 0
+        for var in node.variables:
+            m = _text_re.match(node.text, pos)
+            pos = m.end()
+            text.append(m.group(1))
+            if is_constant(var):
+                try:
+                    text.append(self.render_constant(var.value)
+                                .replace(u'%', u'%%'))
+                    continue
+                except CannotFold:
+                    pass
+            text.append(u'%s')
+            variables.append(var)
+        text.append(node.text[pos:])
+        node.text = u''.join(text)
+        node.variables = variables
+        return node
+
+    def optimize_print(self, node):
+        """
+        Print statements are variable tags.
+        """
+        return self.optimize_text(nodes.Text(u'%s', [node.expr],
+                                             node.lineno, node.filename))
+
+    def optimize_if_condition(self, node):
+        """
+        Drop branches with false constant tests and replace the
+        condition with the body of the first true one.
+        """
+        tests = []
+        for test, body in node.tests:
+            if is_constant(test):
+                if not test.value:
+                    continue
+                if not tests:
+                    return body
+                node.tests = tests
+                node.else_ = body
+                return node
+            tests.append((test, body))
+        if not tests:
+            if node.else_ is None:
+                return nodes.NodeList([], node.lineno, node.filename)
+            return node.else_
+        node.tests = tests
+        return node
+
+    # -- expressions
+
+    def optimize_binary(self, node):
+        """
+        Fold arithmetic on constants.
+        """
+        left = node.left
+        right = node.right
+        if not (is_constant(left) and is_constant(right)):
+            raise CannotFold()
+        left = left.value
+        right = right.value
+        cls = node.__class__
+        # don't create huge strings or numbers at compile time
+        if cls is nodes.PowExpression and not \
+           (isinstance(right, (int, long)) and abs(right) <= 64):
+            raise CannotFold()
+        if cls is nodes.MulExpression:
+            for a, b in (left, right), (right, left):
+                if isinstance(a, basestring) and (not isinstance(b,
+                   (int, long)) or len(a) * b > _max_length):
+                    raise CannotFold()
+        try:
+            value = _binary_operators[cls](left, right)
+        except Exception:
+            raise CannotFold()
+        return make_constant(value, node)
+
+    def optimize_concat(self, node):
+        """
+        Fold concatenations of constants.
+        """
+        for arg in node.args:
+            if not is_constant(arg):
+                raise CannotFold()
+        to_unicode = self.environment.to_unicode
+        return make_constant(u''.join([to_unicode(arg.value)
+                                       for arg in node.args]), node)
+
+    def optimize_compare(self, node):
+        """
+        Fold comparisons of constants.
+        """
+        if not is_constant(node.expr):
+            raise CannotFold()
+        left = node.expr.value
+        for op, n in node.ops:
+            if not is_constant(n):
+                raise CannotFold()
+            try:
+                if not _compare_operators[op](left, n.value):
+                    return make_constant(False, node)
+            except Exception:
+                raise CannotFold()
+            left = n.value
+        return make_constant(True, node)
+
+    def optimize_filter_expr(self, node):
+        """
+        Apply pure filters to constants.
+        """
+        if not is_constant(node.node):
+            raise CannotFold()
+        value = node.node
+        filters = list(node.filters)
+        while filters:
+            name, args = filters[0]
+            for arg in args:
+                if not is_constant(arg):
+                    return node
+            try:
+                func = self.get_filter(name, tuple([arg.value for arg
+                                                    in args]))
+                value = make_constant(self.apply_filter(func, value.value),
+                                      node)
+            except CannotFold:
+                break
+            del filters[0]
+        if not filters:
+            return value
+        node.node = value
+        node.filters = filters
+        return node
+
+    def optimize_conditional_expr(self, node):
+        """
+        Resolve conditional expressions with a constant test.
+        """
+        if not is_constant(node.test):
+            raise CannotFold()
+        if node.test.value:
+            return node.expr1
+        return node.expr2
+
+    def optimize_and(self, node):
+        """
+        Resolve ``and`` with a constant left side.
+        """
+        if not is_constant(node.left):
+            raise CannotFold()
+        if not node.left.value:
+            return node.left
+        return node.right
+
+    def optimize_or(self, node):
+        """
+        Resolve ``or`` with a constant left side.
+        """
+        if not is_constant(node.left):
+            raise CannotFold()
+        if node.left.value:
+            return node.left
+        return node.right
+
+    def optimize_not(self, node):
+        """
+        Fold ``not`` of a constant.
+        """
+        if not is_constant(node.node):
+            raise CannotFold()
+        return make_constant(not node.node.value, node)
+
+    def optimize_neg(self, node):
+        """
+        Fold the negation of a constant number.
+        """
+        if not is_constant(node.node):
+            raise CannotFold()
+        try:
+            return make_constant(-node.node.value, node)
+        except TypeError:
+            raise CannotFold()
+
+    def optimize_pos(self, node):
+        """
+        Fold the unary plus of a constant number.
+        """
+        if not is_constant(node.node):
+            raise CannotFold()
+        try:
+            return make_constant(+node.node.value, node)
+        except TypeError:
+            raise CannotFold()
+
+
+def optimize(environment, node):
+    """
+    Optimize a node tree for the given environment.
+    """
+    return Optimizer(environment).optimize(node)
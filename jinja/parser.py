@@ -39,6 +39,8 @@ end_of_if = StateTest.expect_token('endif')
 end_of_filter = StateTest.expect_token('endfilter')
 end_of_macro = StateTest.expect_token('endmacro')
 end_of_call = StateTest.expect_token('endcall')
+end_of_cache = StateTest(lambda t: t.type == 'name' and t.value == 'endcache',
+                         "expected 'endcache'")
 end_of_block_tag = StateTest.expect_token('endblock')
 end_of_trans = StateTest.expect_token('endtrans')
 
@@ -87,11 +89,19 @@ class Parser(object):
             'trans':        self.parse_trans_directive
         }
 
+        #: directives that are not keywords. they are only recognized
+        #: if the name is the first token of a block tag so that they
+        #: can still be used as variable names.
+        self.name_directives = {
+            'cache':        self.parse_cache_directive,
+            'flush':        self.parse_flush_directive
+        }
+
         #: set of directives that are only available in a certain
         #: context.
         self.context_directives = set([
-            'elif', 'else', 'endblock', 'endfilter', 'endfor', 'endif',
-            'endmacro', 'endraw', 'endtrans', 'pluralize'
+            'elif', 'else', 'endblock', 'endcache', 'endfilter', 'endfor',
+            'endif', 'endmacro', 'endraw', 'endtrans', 'pluralize'
         ])
 
         #: get the `no_variable_block` flag
@@ -293,6 +303,31 @@ class Parser(object):
         self.stream.expect('block_end')
         return nodes.Call(expr, body, token.lineno, self.filename)
 
+    def parse_cache_directive(self):
+        """
+        Handle {% cache key %}...{% endcache %} and
+        {% cache key, timeout %}...{% endcache %}.
+        """
+        token = self.stream.expect('name', 'cache')
+        key = self.parse_expression()
+        if self.stream.current.type == 'comma':
+            self.stream.next()
+            timeout = self.parse_expression()
+        else:
+            timeout = None
+        self.stream.expect('block_end')
+        body = self.subparse(end_of_cache, True)
+        self.stream.expect('block_end')
+        return nodes.Cache(key, timeout, body, token.lineno, self.filename)
+
+    def parse_flush_directive(self):
+        """
+        Handle {% flush %}.
+        """
+        token = self.stream.expect('name', 'flush')
+        self.stream.expect('block_end')
+        return nodes.Flush(token.lineno, self.filename)
+
     def parse_block_directive(self):
         """
         Handle block directives used for inheritance.
@@ -1090,19 +1125,28 @@ class Parser(object):
                     if drop_needle:
                         next()
                     return assemble_list()
-                handler = self.directives.get(self.stream.current.type)
+                token = self.stream.current
+                if token.type == 'name':
+                    handler = self.name_directives.get(token.value)
+                else:
+                    handler = self.directives.get(token.type)
                 if handler is None:
                     if self.no_variable_block:
                         push_variable()
                         self.stream.expect('block_end')
-                    elif self.stream.current.type in self.context_directives:
+                    elif token.type in self.context_directives:
                         raise TemplateSyntaxError('unexpected directive %r.' %
-                                                  self.stream.current.type,
-                                                  lineno, self.filename)
+                                                  token.type, lineno,
+                                                  self.filename)
+                    elif token.type == 'name' and \
+                         token.value in self.context_directives:
+                        raise TemplateSyntaxError('unexpected directive %r.' %
+                                                  token.value, lineno,
+                                                  self.filename)
                     else:
-                        name = self.stream.current.value
                         raise TemplateSyntaxError('unknown directive %r.' %
-                                                  name, lineno, self.filename)
+                                                  token.value, lineno,
+                                                  self.filename)
                 else:
                     node = handler()
                     if node is not None:
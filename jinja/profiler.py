@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+    jinja.profiler
+    ~~~~~~~~~~~~~~
+
+    Render time statistics. Pass a `Profiler` as `profiler` to the
+    environment and all templates compiled by that environment record
+    how long it takes to render them and the blocks, macros and includes
+    in them::
+
+        from jinja import Environment
+        from jinja.profiler import Profiler
+
+        env = Environment(profiler=Profiler())
+        ...
+        for item in env.profiler.get_stats():
+            print item['kind'], item['name'], item['calls'], item['total']
+
+    The timing code is added when the templates are compiled, templates of
+    environments without a profiler don't contain any of it. Times are
+    wall clock times in seconds and include the time spent in nested
+    sections. Sections that raise an exception are not recorded.
+
+    :copyright: 2007 by Armin Ronacher.
+    :license: BSD, see LICENSE for more details.
+"""
+from threading import Lock
+from timeit import default_timer
+
+
+__all__ = ['Profiler']
+
+
+class Profiler(object):
+    """
+    Collects the number of calls and the render times of templates,
+    blocks, macros and includes in the process.
+    """
+
+    def __init__(self, timer=default_timer):
+        self.timer = timer
+        self._stats = {}
+        self._lock = Lock()
+
+    def record(self, kind, template, name, start):
+        """
+        Record a section of the kind `kind` (``'template'``,
+        ``'block'``, ``'macro'`` or ``'include'``) called `name` in
+        `template` that started at `start`.
+        """
+        duration = self.timer() - start
+        key = (kind, template, name)
+        self._lock.acquire()
+        try:
+            item = self._stats.get(key)
+            if item is None:
+                self._stats[key] = [1, duration, duration]
+            else:
+                item[0] += 1
+                item[1] += duration
+                if duration > item[2]:
+                    item[2] = duration
+        finally:
+            self._lock.release()
+
+    def get_stats(self):
+        """
+        Return a list of dicts with the keys ``kind``, ``template``,
+        ``name``, ``calls``, ``total``, ``average`` and ``max``, the
+        slowest sections first.
+        """
+        self._lock.acquire()
+        try:
+            items = [(key, list(value)) for key, value
+                     in self._stats.iteritems()]
+        finally:
+            self._lock.release()
+        result = []
+        for (kind, template, name), (calls, total, max_time) in items:
+            result.append({
+                'kind':         kind,
+                'template':     template,
+                'name':         name,
+                'calls':        calls,
+                'total':        total,
+                'average':      total / calls,
+                'max':          max_time
+            })
+        result.sort(key=lambda x: -x['total'])
+        return result
+
+    def reset(self):
+        """Forget all recorded times."""
+        self._lock.acquire()
+        try:
+            self._stats.clear()
+        finally:
+            self._lock.release()
@@ -16,6 +16,16 @@
     It also adds debug symbols used by the traceback toolkit implemented
     in `jinja.utils`.
 
+    Name Resolution
+    ===============
+
+    Loop variables, ``{% set %}`` targets and macro arguments are bound to
+    python locals wherever the translator can prove that nothing else
+    rebinds them behind its back.  The values are written through to the
+    context as well so that macros, ``super()`` blocks and context
+    callables still see them.  All other names (template globals and the
+    variables passed to `render`) are resolved by the context.
+
     Implementation Details
     ======================
 
@@ -25,6 +35,11 @@
     the translation process, the additional comments and whitespace won't
     appear in the saved bytecode.
 
+    The translator emits source code and not a python `ast` on purpose.
+    Compiling an ast that was built node by node in python is slower than
+    letting CPython parse the source, even without the cost of building
+    the tree.
+
     :copyright: 2007 by Armin Ronacher.
     :license: BSD, see LICENSE for more details.
 """
@@ -35,10 +50,18 @@ from jinja.nodes import get_nodes
 from jinja.parser import Parser
 from jinja.exceptions import TemplateSyntaxError
 from jinja.translators import Translator
+from jinja.optimizer import Optimizer
 from jinja.datastructure import TemplateStream
 from jinja.utils import set, capture_generator
 
 
+#: shortcuts that are not plain attributes of the environment
+_shortcuts = {
+    'finish_var':       'make_finish_var()',
+    'profile_timer':    'profiler.timer',
+    'profile_record':   'profiler.record'
+}
+
 #: regular expression for the debug symbols
 _debug_re = re.compile(r'^\s*\# DEBUG\(filename=(?P<filename>.*?), '
                        r'lineno=(?P<lineno>\d+)\)$')
@@ -63,29 +86,36 @@ class Template(object):
     Represents a finished template.
     """
 
-    def __init__(self, environment, code):
+    def __init__(self, environment, code, dependencies=()):
         self.environment = environment
         self.code = code
+        #: names of the templates compiled into this one (the extends
+        #: chain and all included templates)
+        self.dependencies = tuple(dependencies)
         self.generate_func = None
 
     def dump(self, stream=None):
         """Dump the template into python bytecode."""
+        data = (self.code, self.dependencies)
         if stream is not None:
             from marshal import dump
-            dump(self.code, stream)
+            dump(data, stream)
         else:
             from marshal import dumps
-            return dumps(self.code)
+            return dumps(data)
 
     def load(environment, data):
         """Load the template from python bytecode."""
         if isinstance(data, basestring):
             from marshal import loads
-            code = loads(data)
+            data = loads(data)
         else:
             from marshal import load
-            code = load(data)
-        return Template(environment, code)
+            data = load(data)
+        # bytecode dumped by older jinja versions has no dependencies
+        if data.__class__ is tuple:
+            return Template(environment, *data)
+        return Template(environment, data)
     load = staticmethod(load)
 
     def render(self, *args, **kwargs):
@@ -137,6 +167,172 @@ class Template(object):
         raise exc_type, exc_value, traceback
 
 
+class Frame(object):
+    """
+    Holds the template names a scope of the generated code has bound to
+    python locals. A name mapped to `None` is known to live in the
+    context only, even if an outer frame has a local for it.
+    """
+
+    def __init__(self, parent=None, layer=False, isolated=False):
+        self.parent = parent
+        #: `True` if the frame owns a layer on the context stack
+        self.layer = layer
+        #: isolated frames don't look up names in the parent frames
+        self.isolated = isolated
+        self.names = {}
+        #: names assigned by ``{% set %}`` in this frame
+        self.assigned = set()
+
+    def lookup(self, name):
+        """Return the python local for `name` or `None`."""
+        frame = self
+        while frame is not None:
+            if name in frame.names:
+                return frame.names[name]
+            if frame.isolated:
+                break
+            frame = frame.parent
+
+    def forget(self, name):
+        """Resolve `name` from the context in this and all outer frames."""
+        frame = self
+        while frame is not None:
+            frame.names[name] = None
+            frame = frame.parent
+
+
+def find_assignments(node):
+    """
+    Return the names assigned by ``{% set %}`` on the context layer of
+    `node` and a flag that is `True` if the layer also includes other
+    templates that may assign anything.
+    """
+    names = set()
+    opaque = False
+    todo = [node]
+    while todo:
+        node = todo.pop()
+        if node is None:
+            continue
+        cls = node.__class__
+        if cls is nodes.Set:
+            if node.scope_local:
+                names.add(node.name)
+        elif cls is nodes.Include:
+            opaque = True
+        elif cls is nodes.NodeList:
+            todo.extend(node)
+        elif cls is nodes.IfCondition:
+            todo.extend([body for test, body in node.tests])
+            todo.append(node.else_)
+    return names, opaque
+
+
+def find_loop_usage(node):
+    """
+    Return a tuple ``(uses_loop, calls)`` for the body of a for loop.
+    `uses_loop` is `True` if the body accesses the ``loop`` variable or
+    includes another template that may do that, `calls` is `True` if
+    it calls functions or macros that could look it up in the context
+    or change it, or includes another template.
+    """
+    uses_loop = calls = False
+    todo = [node]
+    while todo:
+        node = todo.pop()
+        if isinstance(node, (list, tuple)):
+            todo.extend(node)
+            continue
+        elif not isinstance(node, nodes.Node):
+            continue
+        cls = node.__class__
+        if cls is nodes.Include:
+            return True, True
+        elif cls is nodes.NameExpression:
+            if node.name == 'loop':
+                uses_loop = True
+        elif cls in (nodes.CallExpression, nodes.Call):
+            calls = True
+        todo.extend(node.get_items())
+    return uses_loop, calls
+
+
+def find_super_offsets(node):
+    """
+    Return the offsets of the ``super()`` calls in the body of a block or
+    `None` if `super` is used in a way that can't be resolved when the
+    template is compiled (passed around, used in a macro or possibly in
+    an included template).  Nested blocks are not searched.
+    """
+    offsets = []
+    todo = [(node, False)]
+    while todo:
+        node, in_macro = todo.pop()
+        if isinstance(node, (list, tuple)):
+            todo.extend([(item, in_macro) for item in node])
+            continue
+        elif not isinstance(node, nodes.Node):
+            continue
+        cls = node.__class__
+        if cls is nodes.Block:
+            continue
+        elif cls is nodes.Include or (cls is nodes.Set and
+                                      node.name == 'super'):
+            return None
+        elif cls is nodes.NameExpression:
+            if node.name == 'super':
+                return None
+        elif cls is nodes.CallExpression and \
+             node.node.__class__ is nodes.NameExpression and \
+             node.node.name == 'super':
+            if in_macro or node.kwargs or node.dyn_args is not None or \
+               node.dyn_kwargs is not None or len(node.args) > 1:
+                return None
+            if not node.args:
+                offsets.append(1)
+                continue
+            offset = node.args[0]
+            if offset.__class__ is not nodes.ConstantExpression or \
+               offset.value.__class__ is not int:
+                return None
+            offsets.append(offset.value)
+            continue
+        todo.extend([(item, in_macro or cls is nodes.Macro)
+                     for item in node.get_items()])
+    return offsets
+
+
+def find_macro_super(node, parse):
+    """
+    Return `True` if a macro or call block in `node` references `super`.
+    Those look up the `super` of the block they are called from, so
+    such templates can't resolve ``super()`` at compile time. Included
+    templates are loaded with `parse` and searched too.
+    """
+    seen = set()
+    todo = [(node, False)]
+    while todo:
+        node, in_macro = todo.pop()
+        if isinstance(node, (list, tuple)):
+            todo.extend([(item, in_macro) for item in node])
+            continue
+        elif not isinstance(node, nodes.Node):
+            continue
+        cls = node.__class__
+        if cls is nodes.NameExpression:
+            if in_macro and node.name == 'super':
+                return True
+        elif cls is nodes.Include:
+            if node.template not in seen:
+                seen.add(node.template)
+                todo.append((parse(node.template), in_macro))
+            continue
+        todo.extend([(item, in_macro or cls in (nodes.Macro, nodes.Call))
+                     for item in node.get_items()])
+    return False
+
+
 class PythonTranslator(Translator):
     """
     Pass this translator a ast tree to get valid python code.
@@ -149,6 +345,9 @@ class PythonTranslator(Translator):
         self.source = source
         self.closed = False
 
+        #: names of the extended and included templates
+        self.dependencies = []
+
         #: current level of indention
         self.indention = 0
         #: each {% cycle %} tag has a unique ID which increments
@@ -166,6 +365,31 @@ class PythonTranslator(Translator):
         self.need_set_import = False
         #: flag for regular expressions
         self.compiled_regular_expressions = {}
+        #: filters and tests with constant arguments that are bound
+        #: when the template is loaded, in order of appearance
+        self.bound_factories = []
+        #: the frame of the scope that is translated right now
+        self.frame = None
+        #: names that are never bound to python locals
+        self.unbound_names = set()
+        #: cleared if a template captures into a dynamic name
+        self.bind_locals = True
+        #: `True` if a macro may access the ``loop`` of its caller
+        self.macros_use_loop = False
+        #: number of functions in the block mapping per block name
+        self.block_counts = {}
+        #: ``(name, level)`` of the block whose ``super()`` calls are
+        #: resolved at compile time
+        self.super_block = None
+        #: resolve ``super()`` at compile time, cleared if a macro
+        #: references ``super``
+        self.flatten_inheritance = environment.flatten_inheritance
+        #: each python local gets a unique ID
+        self.last_local_id = 0
+        #: add timing code for the profiler of the environment
+        self.profiling = environment.profiler is not None
+        #: folds constants before the nodes are translated
+        self.optimizer = Optimizer(environment)
 
         #: bind the nodes to the callback functions. There are
         #: some missing! A few are specified in the `unhandled`
@@ -185,6 +409,8 @@ class PythonTranslator(Translator):
             nodes.Call:                     self.handle_call,
             nodes.Set:                      self.handle_set,
             nodes.Filter:                   self.handle_filter,
+            nodes.Cache:                    self.handle_cache,
+            nodes.Flush:                    self.handle_flush,
             nodes.Block:                    self.handle_block,
             nodes.Include:                  self.handle_include,
             nodes.Trans:                    self.handle_trans,
@@ -231,7 +457,8 @@ class PythonTranslator(Translator):
         translator = PythonTranslator(environment, node, source)
         filename = node.filename or '<template>'
         source = translator.translate()
-        return Template(environment, compile(source, filename, 'exec'))
+        return Template(environment, compile(source, filename, 'exec'),
+                        translator.dependencies)
     process = staticmethod(process)
 
     # -- private helper methods
@@ -252,6 +479,38 @@ class PythonTranslator(Translator):
             len(args) == 1 and ',' or ''
         )
 
+    def start_timer(self):
+        """
+        Return the name of a new local and the line that stores the time
+        in it if profiling is enabled, otherwise ``(None, None)``.
+        """
+        if not self.profiling:
+            return None, None
+        self.last_local_id += 1
+        var = 't_%d' % self.last_local_id
+        self.used_shortcuts.add('profile_timer')
+        return var, self.indent('%s = profile_timer()' % var)
+
+    def stop_timer(self, var, kind, template, name):
+        """
+        Return the line that records the time since `start_timer`.
+        """
+        self.used_shortcuts.add('profile_record')
+        return self.indent('profile_record(%r, %r, %r, %s)' % (
+                           kind, template, name, var))
+
+    def profile(self, kind, template, name, code):
+        """
+        Wrap inlined code in timing code if profiling is enabled.
+        """
+        if not code:
+            return code
+        var, start = self.start_timer()
+        if var is None:
+            return code
+        return '\n'.join([start, code,
+                          self.stop_timer(var, kind, template, name)])
+
     def nodeinfo(self, node, force=False):
         """
         Return a comment that helds the node informations or None
@@ -274,6 +533,164 @@ class PythonTranslator(Translator):
         else:
             raise AssertionError('unhandled node %r' % node.__class__)
 
+    def push_frame(self, layer=False, isolated=False):
+        """
+        Enter a new scope. Layer frames are used for everything that
+        pushes a layer on the context stack, isolated frames for code
+        that runs with an unknown context such as macros.
+        """
+        self.frame = Frame(self.frame, layer, isolated)
+        return self.frame
+
+    def pop_frame(self):
+        """
+        Leave the current scope. Names a plain frame (the body of an
+        if condition for example) assigned are not reliable afterwards
+        because the assignment might not have happened, so they are
+        resolved from the context until the layer is left.
+        """
+        frame = self.frame
+        self.frame = parent = frame.parent
+        if not frame.layer and parent is not None:
+            for name in frame.assigned:
+                parent.names[name] = None
+                parent.assigned.add(name)
+
+    def can_bind(self, name):
+        """
+        Check if a template name may be kept in a python local.
+        """
+        return self.bind_locals and name not in self.unbound_names
+
+    def bind(self, name):
+        """
+        Bind a template name to a new python local in the current frame
+        and return the name of the local. If the name must be resolved
+        from the context the return value is `None`.
+        """
+        if not self.can_bind(name):
+            self.frame.names[name] = None
+            return
+        self.last_local_id += 1
+        local = 'l_%s_%d' % (name, self.last_local_id)
+        self.frame.names[name] = local
+        return local
+
+    def unbind(self, name):
+        """
+        Never bind `name` to a local again and forget the current locals.
+        """
+        self.unbound_names.add(name)
+        if self.frame is not None:
+            self.frame.forget(name)
+
+    def check_capture(self, filters):
+        """
+        The capture filter writes into the context, the captured name
+        can't be kept in a local.
+        """
+        for name, args in filters:
+            if name == 'capture':
+                if args and args[0].__class__ is nodes.ConstantExpression:
+                    self.unbind(args[0].value)
+                else:
+                    self.bind_locals = False
+
+    def collect_unbound(self, node):
+        """
+        Look for names that may be rebound by other scopes: targets of
+        ``{% set foo = bar! %}`` and capture filters.
+        """
+        todo = [node]
+        while todo:
+            node = todo.pop()
+            if node.__class__ is nodes.Set and not node.scope_local:
+                self.unbind(node.name)
+            elif node.__class__ in (nodes.Filter, nodes.FilterExpression):
+                self.check_capture(node.filters)
+            todo.extend(node.get_child_nodes())
+
+    def bind_factory(self, kind, name, args):
+        """
+        Return the name of the module level binding for the filter or
+        test (`kind`) `name` if all `args` are constant, `None` otherwise.
+        """
+        for arg in args:
+            if arg.__class__ not in (nodes.ConstantExpression,
+                                     nodes.RegexExpression):
+                return None
+        args = self.to_tuple(map(self.handle_node, args))
+        for item in self.bound_factories:
+            if item[:3] == (kind, name, args):
+                return item[3]
+        var = '%s_%d' % (kind, len(self.bound_factories))
+        self.bound_factories.append((kind, name, args, var))
+        return var
+
+    def apply_filters(self, value, filters):
+        """
+        Return the python expression that applies `filters` on `value`.
+        Filters with constant arguments are called directly.
+        """
+        dynamic = []
+        for name, args in filters:
+            func = self.bind_factory('filter', name, args)
+            if func is None:
+                dynamic.append('(%r, %s)' % (
+                    name,
+                    self.to_tuple(map(self.handle_node, args))
+                ))
+                continue
+            if dynamic:
+                self.used_shortcuts.add('apply_filters')
+                value = 'apply_filters(%s, context, %s)' % (
+                        value, self.to_tuple(dynamic))
+                dynamic = []
+            value = '%s(environment, context, %s)' % (func, value)
+        if dynamic:
+            self.used_shortcuts.add('apply_filters')
+            value = 'apply_filters(%s, context, %s)' % (
+                    value, self.to_tuple(dynamic))
+        return value
+
+    def check_macros(self, node):
+        """
+        Macros resolve names from the context of the caller, so if one
+        of them uses ``loop`` all loops that call something need a
+        `LoopContext`.
+        """
+        if not self.macros_use_loop:
+            for n in get_nodes(nodes.Macro, node, False):
+                if find_loop_usage(n.body)[0]:
+                    self.macros_use_loop = True
+                    break
+
+    def assign_target(self, node, names, bind=True):
+        """
+        Return the python assignment target for a for loop target and
+        append the `(name, local)` tuples for all bound names to `names`.
+        If `bind` is `False` the names are assigned to the context only.
+        """
+        if node.__class__ is nodes.TupleExpression:
+            return self.to_tuple([self.assign_target(n, names, bind)
+                                  for n in node.items])
+        if bind:
+            local = self.bind(node.name)
+        else:
+            local = self.frame.names[node.name] = None
+        if local is None:
+            return 'context[%r]' % node.name
+        names.append((node.name, local))
+        return local
+
+    def add_dependency(self, name):
+        """
+        Remember that the output depends on the template `name`.
+        """
+        name = str(name)
+        if name not in self.dependencies:
+            self.dependencies.append(name)
+
     def close(self):
         """
         Clean up stuff.
@@ -333,6 +750,7 @@ class PythonTranslator(Translator):
             # is only used for this templated
             parent = self.loader.parse(node.extends,
                                        node.filename)
+            self.add_dependency(node.extends)
 
             # look up all block nodes in the current template and
             # add them to the override dict.
@@ -350,15 +768,41 @@ class PythonTranslator(Translator):
             # make the parent node the new node
             node = parent
 
+        # fold constants and merge static data
+        optimize = self.optimizer.optimize
+        node.body = optimize(node.body)
+        requirements = map(optimize, requirements)
+        for items in blocks.itervalues():
+            items[:] = map(optimize, items)
+        for name, items in blocks.iteritems():
+            self.block_counts[name] = len(items)
+
+        # macros see the super of the block they are called from
+        if self.flatten_inheritance:
+            parse = self.environment.loader.parse
+            for n in [node] + requirements + sum(blocks.values(), []):
+                if find_macro_super(n, parse):
+                    self.flatten_inheritance = False
+                    break
+
+        # names that other scopes may rebind are never kept in locals
+        for n in [node] + requirements + sum(blocks.values(), []):
+            self.collect_unbound(n)
+            self.check_macros(n)
+
         # handle requirements code
         if requirements:
             requirement_lines = ['def bootstrap(context):']
+            self.push_frame(True, True)
             for n in requirements:
                 requirement_lines.append(self.handle_node(n))
+            self.pop_frame()
             requirement_lines.append('    if 0: yield None\n')
 
         # handle body in order to get the used shortcuts
+        self.push_frame(True, True)
         body_code = self.handle_node(node.body)
+        self.pop_frame()
 
         # same for blocks in callables
         block_lines = []
@@ -371,7 +815,9 @@ class PythonTranslator(Translator):
                 # ensure that the indention is correct
                 self.indention = 1
                 func_name = 'block_%s_%s' % (name, idx)
+                self.push_frame(True, True)
                 data = self.handle_block(item, idx + 1)
+                self.pop_frame()
                 # blocks with data
                 if data:
                     block_lines.extend([
@@ -392,6 +838,12 @@ class PythonTranslator(Translator):
                 self.to_tuple(tmp)
             ))
 
+        # time the whole template if profiling is enabled
+        self.indention = 1
+        timer, start = self.start_timer()
+        if timer is not None:
+            self.used_shortcuts.add('profile_record')
+
         # bootstrapping code
         lines = ['# Essential imports', 'from __future__ import division']
         if self.used_utils:
@@ -412,6 +864,13 @@ class PythonTranslator(Translator):
             for regex, name in self.compiled_regular_expressions.iteritems():
                 lines.append('%s = re.compile(%r)' % (name, regex))
 
+        # bind filters and tests with constant arguments
+        if self.bound_factories:
+            lines.append('\n# Filters and tests with constant arguments')
+            for kind, name, args, var in self.bound_factories:
+                lines.append('%s = environment.bind_%s(%r, %s)' % (
+                             var, kind, name, args))
+
         lines.append(
             '\n# Aliases for some speedup\n'
             '%s\n\n'
@@ -422,17 +881,22 @@ class PythonTranslator(Translator):
             'def generate(context):\n'
             '    assert environment is context.environment' % (
                 '\n'.join([
-                    '%s = environment.%s' % (item, item) for item in
-                    self.used_shortcuts
+                    '%s = environment.%s' % (item, _shortcuts.get(item, item))
+                    for item in self.used_shortcuts
                 ]),
                 outer_filename
             )
         )
 
         # the template body
+        if timer is not None:
+            lines.append(start)
         if requirements:
             lines.append('    for item in bootstrap(context): pass')
         lines.append(body_code)
+        if timer is not None:
+            lines.append(self.stop_timer(timer, 'template', outer_filename,
+                                         outer_filename))
         lines.append('    if 0: yield None\n')
 
         # now write the bootstrapping (requirements) core if there is one
@@ -539,7 +1003,9 @@ class PythonTranslator(Translator):
 
         If the nodelist was empty it will return an empty string
         """
+        self.push_frame()
         body = '\n'.join([self.handle_node(n) for n in node])
+        self.pop_frame()
         if body:
             return self.indent(self.nodeinfo(node)) + '\n' + body
         return ''
@@ -547,46 +1013,107 @@ class PythonTranslator(Translator):
     def handle_for_loop(self, node):
         """
         Handle a for loop. Pretty basic, just that we give the else
-        clause a different behavior.
+        clause a different behavior.  Loops that don't access ``loop``
+        become plain python loops.
+
+        The loop layer stays the same for all iterations so names that
+        are assigned in the body are resolved from the context until
+        the assignment happened. Recursive loops share the layer with
+        the recursive calls, they don't bind locals for their targets.
+        Neither do loops that call functions or include templates,
+        because context callables and included templates may assign to
+        the loop variables:
+
+        >>> from jinja import Environment, DictLoader
+        >>> from jinja.datastructure import contextcallable
+        >>> def set_item(env, context):
+        ...     context['item'] = 'B'
+        ...     return ''
+        >>> env = Environment(loader=DictLoader({'set': '{% set item = "B" %}'}))
+        >>> tmpl = env.from_string('{% for item in seq %}{{ set_item() }}'
+        ...                        '{{ item }}{% endfor %}')
+        >>> tmpl.render(seq=[1, 2], set_item=contextcallable(set_item))
+        u'BB'
+        >>> tmpl = env.from_string('{% for item in seq %}{% include "set" %}'
+        ...                        '{{ item }}{% endfor %}')
+        >>> tmpl.render(seq=[1, 2])
+        u'BB'
         """
-        self.used_data_structures.add('LoopContext')
         buf = []
         write = lambda x: buf.append(self.indent(x))
         write(self.nodeinfo(node))
         write('context.push()')
+        seq = self.handle_node(node.seq)
+        assigned, opaque = find_assignments(node.body)
 
         # recursive loops
         if node.recursive:
+            self.used_data_structures.add('LoopContext')
+            frame = self.push_frame(True)
+            for name in assigned:
+                frame.names[name] = None
+            for n in get_nodes(nodes.NameExpression, node.item, False):
+                frame.names[n.name] = None
+            frame.names['loop'] = loop = None
             write('def loop(seq):')
             self.indention += 1
             write('for %s in context[\'loop\'].push(seq):' %
                 self.handle_node(node.item),
             )
+            self.indention += 1
 
         # simple loops
         else:
-            write('context[\'loop\'] = loop = LoopContext(%s, '
-                  'context[\'loop\'], None)' % self.handle_node(node.seq))
-            write('for %s in loop:' %
-                self.handle_node(node.item)
-            )
+            frame = self.push_frame(True, opaque)
+            for name in assigned:
+                frame.names[name] = None
+            uses_loop, calls = find_loop_usage([node.item, node.body])
+            if node.else_ or uses_loop or (calls and self.macros_use_loop):
+                self.used_data_structures.add('LoopContext')
+                self.last_local_id += 1
+                loop = 'l_loop_%d' % self.last_local_id
+                write('context[\'loop\'] = %s = LoopContext(%s, %s, '
+                      'None)' % (
+                    loop,
+                    seq,
+                    self.handle_name(nodes.NameExpression('loop'))
+                ))
+                if self.can_bind('loop') and not calls:
+                    frame.names['loop'] = loop
+            else:
+                self.used_utils.add('sequence_or_empty')
+                loop = 'sequence_or_empty(%s)' % seq
+            targets = []
+            write('for %s in %s:' % (
+                self.assign_target(node.item, targets, not calls),
+                loop
+            ))
+            self.indention += 1
+            for name, local in targets:
+                write('context[%r] = %s' % (name, local))
 
         # handle real loop code
-        self.indention += 1
         write(self.nodeinfo(node.body))
         if node.body:
             buf.append(self.handle_node(node.body))
-        else:
+        elif node.recursive or not targets:
             write('pass')
         self.indention -= 1
+        self.pop_frame()
 
-        # else part of loop
+        # else part of loop. the targets were never assigned but the
+        # loop variable is still the one of this loop.
         if node.else_:
-            write('if not context[\'loop\'].iterated:')
+            frame = self.push_frame(True)
+            for n in get_nodes(nodes.NameExpression, node.item, False):
+                frame.names[n.name] = None
+            frame.names['loop'] = loop
+            write('if not %s.iterated:' % (loop or 'context[\'loop\']'))
             self.indention += 1
             write(self.nodeinfo(node.else_))
             buf.append(self.handle_node(node.else_) or self.indent('pass'))
             self.indention -= 1
+            self.pop_frame()
 
         # call recursive for loop!
         if node.recursive:
@@ -596,7 +1123,7 @@ class PythonTranslator(Translator):
             write('context[\'loop\'] = LoopContext(None, context[\'loop\'], '
                   'buffereater(loop))')
             self.used_utils.add('buffereater')
-            write('for item in loop(%s):' % self.handle_node(node.seq))
+            write('for item in loop(%s):' % seq)
             self.indention += 1
             write('yield item')
             self.indention -= 1
@@ -677,7 +1204,8 @@ class PythonTranslator(Translator):
 
     def handle_macro(self, node):
         """
-        Handle macro declarations.
+        Handle macro declarations. The arguments are bound to locals,
+        everything else is resolved from the context of the caller.
         """
         buf = []
         write = lambda x: buf.append(self.indent(x))
@@ -685,6 +1213,10 @@ class PythonTranslator(Translator):
         write('def macro(*args, **kw):')
         self.indention += 1
         write(self.nodeinfo(node))
+        timer, start = self.start_timer()
+        if timer is not None:
+            buf.append(start)
+        frame = self.push_frame(True, True)
 
         # collect macro arguments
         arg_items = []
@@ -694,41 +1226,46 @@ class PythonTranslator(Translator):
         # build (for example cpython > 2.4) we can use them, they
         # will perform slightly better.
         if have_conditional_expr:
-            arg_tmpl = '\'%(name)s\': args[%(pos)d] if argcount > %(pos)d ' \
-                       'else %(default)s'
+            arg_tmpl = 'args[%(pos)d] if argcount > %(pos)d else %(default)s'
         # otherwise go with the and/or tuple hack:
         else:
-            arg_tmpl = '\'%(name)s\': (argcount > %(pos)d and '\
-                       '(args[%(pos)d],) or (%(default)s,))[0]'
+            arg_tmpl = '(argcount > %(pos)d and (args[%(pos)d],) or '\
+                       '(%(default)s,))[0]'
 
         if node.arguments:
-            varargs_init = '\'varargs\': args[%d:]' % len(node.arguments)
+            varargs_init = 'args[%d:]' % len(node.arguments)
             write('argcount = len(args)')
             for idx, (name, n) in enumerate(node.arguments):
-                arg_items.append(arg_tmpl % {
-                    'name':     name,
+                arg_items.append((name, arg_tmpl % {
                     'pos':      idx,
                     'default':  n is None and 'undefined_singleton' or
                                 self.handle_node(n)
-                })
+                }))
                 if name == 'caller':
                     caller_overridden = True
                 elif name == 'varargs':
                     varargs_init = None
         else:
-            varargs_init = '\'varargs\': args'
+            varargs_init = 'args'
 
         if caller_overridden:
             write('kw.pop(\'caller\', None)')
         else:
-            arg_items.append('\'caller\': kw.pop(\'caller\', undefined_singleton)')
+            arg_items.append(('caller',
+                              'kw.pop(\'caller\', undefined_singleton)'))
         if varargs_init:
-            arg_items.append(varargs_init)
-
-        write('context.push({%s})' % ',\n              '.join([
-            idx and self.indent(item) or item for idx, item
-            in enumerate(arg_items)
-        ]))
+            arg_items.append(('varargs', varargs_init))
+
+        # the defaults are evaluated before the arguments are known
+        layer = []
+        for name, value in arg_items:
+            self.last_local_id += 1
+            local = 'l_%s_%d' % (name, self.last_local_id)
+            write('%s = %s' % (local, value))
+            layer.append('%r: %s' % (name, local))
+            if self.can_bind(name):
+                frame.names[name] = local
+        write('context.push({%s})' % ', '.join(layer))
 
         # disallow any keyword arguments
         write('if kw:')
@@ -742,7 +1279,11 @@ class PythonTranslator(Translator):
         data = self.handle_node(node.body)
         if data:
             buf.append(data)
+        self.pop_frame()
         write('context.pop()')
+        if timer is not None:
+            buf.append(self.stop_timer(timer, 'macro', node.filename,
+                                       node.name))
         write('if 0: yield None')
         self.indention -= 1
         buf.append(self.indent('context[%r] = buffereater(macro, True)' %
@@ -753,7 +1294,9 @@ class PythonTranslator(Translator):
 
     def handle_call(self, node):
         """
-        Handle extended macro calls.
+        Handle extended macro calls. The body runs inside of the macro
+        with unknown arguments pushed, so it resolves everything from
+        the context.
         """
         buf = []
         write = lambda x: buf.append(self.indent(x))
@@ -761,7 +1304,9 @@ class PythonTranslator(Translator):
         write('def call(**kwargs):')
         self.indention += 1
         write('context.push(kwargs)')
+        self.push_frame(True, True)
         data = self.handle_node(node.body)
+        self.pop_frame()
         if data:
             buf.append(data)
         write('context.pop()')
@@ -777,15 +1322,18 @@ class PythonTranslator(Translator):
         """
         Handle variable assignments.
         """
-        if node.scope_local:
-            tmpl = 'context[%r] = %s'
+        expr = self.handle_node(node.expr)
+        if not node.scope_local:
+            self.unbind(node.name)
+            code = 'context.set_nonlocal(%r, %s)' % (node.name, expr)
         else:
-            tmpl = 'context.set_nonlocal(%r, %s)'
-        return self.indent(self.nodeinfo(node)) + '\n' + \
-               self.indent(tmpl % (
-            node.name,
-            self.handle_node(node.expr)
-        ))
+            local = self.bind(node.name)
+            self.frame.assigned.add(node.name)
+            if local is None:
+                code = 'context[%r] = %s' % (node.name, expr)
+            else:
+                code = 'context[%r] = %s = %s' % (node.name, local, expr)
+        return self.indent(self.nodeinfo(node)) + '\n' + self.indent(code)
 
     def handle_filter(self, node):
         """
@@ -793,49 +1341,110 @@ class PythonTranslator(Translator):
         """
         buf = []
         write = lambda x: buf.append(self.indent(x))
+        self.check_capture(node.filters)
         write('def filtered():')
         self.indention += 1
         write('context.push()')
         write(self.nodeinfo(node.body))
+        self.push_frame(True)
         data = self.handle_node(node.body)
+        self.pop_frame()
         if data:
             buf.append(data)
         write('context.pop()')
         write('if 0: yield None')
         self.indention -= 1
-        self.used_shortcuts.add('apply_filters')
-        write('yield apply_filters(buffereater(filtered)(), context, %s)' %
-            self.to_tuple(['(%r, %s)' % (
-                name,
-                self.to_tuple(map(self.handle_node, args))
-            ) for name, args in node.filters])
-        )
+        write('yield ' + self.apply_filters('buffereater(filtered)()',
+                                            node.filters))
+        self.used_utils.add('buffereater')
+        return '\n'.join(buf)
+
+    def handle_cache(self, node):
+        """
+        Handle fragment caching sections. The body is only rendered if
+        the fragment cache of the environment doesn't know the key. The
+        key is stored together with the name of the template so that
+        templates don't overwrite each other's fragments.
+        """
+        buf = []
+        write = lambda x: buf.append(self.indent(x))
+        key = self.handle_node(node.key)
+        if node.timeout is None:
+            timeout = 'None'
+        else:
+            timeout = self.handle_node(node.timeout)
+        write('def cached():')
+        self.indention += 1
+        write('context.push()')
+        write(self.nodeinfo(node.body))
+        self.push_frame(True)
+        data = self.handle_node(node.body)
+        self.pop_frame()
+        if data:
+            buf.append(data)
+        write('context.pop()')
+        write('if 0: yield None')
+        self.indention -= 1
+        write(self.nodeinfo(node))
+        self.used_shortcuts.add('cache_fragment')
+        write('yield cache_fragment((%r, %s), %s, buffereater(cached))' %
+              (node.filename, key, timeout))
         self.used_utils.add('buffereater')
         return '\n'.join(buf)
 
+    def handle_flush(self, node):
+        """
+        Handle flush tags. Buffered template streams yield their buffer
+        when they see the marker, everything else ignores it.
+        """
+        self.used_data_structures.add('flush_marker')
+        return self.indent(self.nodeinfo(node)) + '\n' + \
+               self.indent('yield flush_marker')
+
     def handle_block(self, node, level=0):
         """
         Handle blocks in the sourcecode. We only use them to
         call the current block implementation that is stored somewhere
         else.
         """
-        rv = self.handle_node(node.body)
+        old_super_block = self.super_block
+        self.super_block = None
+        if self.flatten_inheritance:
+            offsets = find_super_offsets(node.body)
+            if offsets is not None:
+                count = self.block_counts.get(str(node.name), 0)
+                for offset in offsets:
+                    if not 0 <= level + offset - 1 < count:
+                        break
+                else:
+                    self.super_block = (str(node.name), level)
+
+        frame = self.push_frame(True)
+        frame.names['super'] = None
+        try:
+            rv = self.handle_node(node.body)
+        finally:
+            static = self.super_block is not None
+            self.super_block = old_super_block
+        self.pop_frame()
         if not rv:
             return ''
 
-        self.used_data_structures.add('SuperBlock')
         buf = []
         write = lambda x: buf.append(self.indent(x))
 
         write(self.nodeinfo(node))
-        write('context.push({\'super\': SuperBlock(%r, blocks, %r, context)})' % (
-            str(node.name),
-            level
-        ))
+        if static:
+            write('context.push()')
+        else:
+            self.used_data_structures.add('SuperBlock')
+            write('context.push({\'super\': SuperBlock(%r, blocks, %r, '
+                  'context)})' % (str(node.name), level))
         write(self.nodeinfo(node.body))
         buf.append(rv)
         write('context.pop()')
-        return '\n'.join(buf)
+        return self.profile('block', node.filename, str(node.name),
+                            '\n'.join(buf))
 
     def handle_include(self, node):
         """
@@ -843,8 +1452,13 @@ class PythonTranslator(Translator):
         """
         tmpl = self.loader.parse(node.template,
                                  node.filename)
+        self.add_dependency(node.template)
+        tmpl.body = self.optimizer.optimize(tmpl.body)
+        self.collect_unbound(tmpl.body)
+        self.check_macros(tmpl.body)
         try:
-            return self.handle_node(tmpl.body)
+            return self.profile('include', node.filename, node.template,
+                                self.handle_node(tmpl.body))
         finally:
             self.loader.mark_as_processed()
 
@@ -878,6 +1492,10 @@ class PythonTranslator(Translator):
         """
         if node.name == '_':
             return 'context.translate_func'
+        if self.frame is not None:
+            local = self.frame.lookup(node.name)
+            if local is not None:
+                return local
         return 'context[%r]' % node.name
 
     def handle_compare(self, node):
@@ -905,6 +1523,12 @@ class PythonTranslator(Translator):
         """
         Handle test calls.
         """
+        func = self.bind_factory('test', node.name, node.args)
+        if func is not None:
+            return '(not not %s(environment, context, %s))' % (
+                func,
+                self.handle_node(node.node)
+            )
         self.used_shortcuts.add('perform_test')
         return 'perform_test(context, %r, %s, %s)' % (
             node.name,
@@ -954,19 +1578,21 @@ class PythonTranslator(Translator):
         """
         We use the pipe operator for filtering.
         """
-        self.used_shortcuts.add('apply_filters')
-        return 'apply_filters(%s, context, %s)' % (
-            self.handle_node(node.node),
-            self.to_tuple(['(%r, %s)' % (
-                name,
-                self.to_tuple(map(self.handle_node, args))
-            ) for name, args in node.filters])
-        )
+        self.check_capture(node.filters)
+        return self.apply_filters(self.handle_node(node.node), node.filters)
 
     def handle_call_expr(self, node, extra_kwargs=None):
         """
         Handle function calls.
         """
+        # super() calls that are resolved at compile time
+        if self.super_block is not None and \
+           node.node.__class__ is nodes.NameExpression and \
+           node.node.name == 'super':
+            name, level = self.super_block
+            if node.args:
+                level += node.args[0].value - 1
+            return 'blocks[%r][%d](context)' % (name, level)
         args = []
         kwargs = {}
         dyn_args = dyn_kwargs = None
@@ -29,8 +29,7 @@ except (ImportError, AttributeError):
     class deque(list):
         """
         Minimal subclass of list that provides the deque
-        interface used by the native `BaseContext` and the
-        `CacheDict`
+        interface used by the native `BaseContext`
         """
         def appendleft(self, item):
             list.insert(self, 0, item)
@@ -188,10 +187,10 @@ def from_string(source):
 #: minor speedup
 _getattr = getattr
 
-def get_attribute(obj, name):
+def check_attribute(obj, name):
     """
-    Return the attribute from name. Raise either `AttributeError`
-    or `SecurityException` if something goes wrong.
+    Raise either `AttributeError` or `SecurityException` if templates
+    are not allowed to access the attribute `name` of `obj`.
     """
     if not isinstance(name, basestring):
         raise AttributeError(name)
@@ -204,6 +203,14 @@ def get_attribute(obj, name):
     if r is not None and name not in r:
         raise SecurityException('disallowed attribute accessed')
 
+
+def get_attribute(obj, name):
+    """
+    Return the attribute from name. Raise either `AttributeError`
+    or `SecurityException` if something goes wrong.
+    """
+    check_attribute(obj, name)
+
     # attribute lookups convert unicode strings to ascii bytestrings.
     # this process could raise an UnicodeEncodeError.
     try:
@@ -386,6 +393,17 @@ def empty_block(context):
     if 0: yield None
 
 
+def sequence_or_empty(seq):
+    """
+    Used by the python translator for loops without a `LoopContext`.
+    Iterating over `None` is the same as iterating over an empty
+    sequence.
+    """
+    if seq is None:
+        return ()
+    return seq
+
+
 def collect_translations(ast):
     """
     Collect all translatable strings for the given ast. The
@@ -506,56 +524,89 @@ class CacheDict(object):
 
     If you want to iterate the other way round use ``reverse(cache)``.
 
-    Implementation note: This is not a nice way to solve that problem but
-    for smaller capacities it's faster than a linked list.
-    Perfect for template environments where you don't expect too many
-    different keys.
+    Instead of (or in addition to) the number of items the cache can be
+    limited by weight. Pass a `weigh` function that returns the weight
+    (for example the size in bytes) of a value and the `max_weight`::
+
+        >>> cache = CacheDict(100, max_weight=10, weigh=len)
+        >>> cache['A'] = 'x' * 6
+        >>> cache['B'] = 'x' * 6
+        >>> cache.keys(), cache.weight
+        (['B'], 6)
+
+    Values heavier than `max_weight` are not kept at all and leave the
+    other items alone::
+
+        >>> cache['C'] = 'x' * 11
+        >>> cache.keys(), cache.weight
+        (['B'], 6)
+
+    The number of `hits`, `misses` and `evictions` is counted::
+
+        >>> cache['B'] and cache.get('A')
+        >>> cache.hits, cache.misses, cache.evictions
+        (1, 1, 1)
+
+    Implementation note: the recency order is kept in a doubly linked
+    list so lookups, updates and evictions are O(1) for any capacity.
     """
 
-    def __init__(self, capacity):
+    def __init__(self, capacity, max_weight=None, weigh=None):
         self.capacity = capacity
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.weight = 0
+        self.hits = self.misses = self.evictions = 0
         self._mapping = {}
-        self._queue = deque()
-
-        # alias all queue methods for faster lookup
-        self._popleft = self._queue.popleft
-        self._pop = self._queue.pop
-        self._remove = self._queue.remove
-        self._append = self._queue.append
+        # circular linked list with the sentinel `_root`. the nodes are
+        # lists in the form [prev, next, key, value, weight], the oldest
+        # item is ``_root[1]``, the most recently used one ``_root[0]``.
+        self._root = root = []
+        root[:] = [root, root, None, None, 0]
 
     def copy(self):
         """
         Return an shallow copy of the instance.
         """
-        rv = CacheDict(self.capacity)
-        rv._mapping.update(self._mapping)
-        rv._queue = self._queue[:]
+        rv = CacheDict(self.capacity, self.max_weight, self.weigh)
+        for key in self.__reversed__():
+            rv[key] = self._mapping[key][3]
         return rv
 
     def get(self, key, default=None):
         """
         Return an item from the cache dict or `default`
         """
-        if key in self:
+        try:
             return self[key]
-        return default
+        except KeyError:
+            return default
 
     def setdefault(self, key, default=None):
         """
         Set `default` if the key is not in the cache otherwise
         leave unchanged. Return the value of this key.
         """
-        if key in self:
+        try:
             return self[key]
-        self[key] = default
-        return default
+        except KeyError:
+            self[key] = default
+            return default
 
     def clear(self):
         """
         Clear the cache dict.
         """
         self._mapping.clear()
-        self._queue.clear()
+        root = self._root
+        root[:] = [root, root, None, None, 0]
+        self.weight = 0
+
+    def keys(self):
+        """
+        Return a list of all keys ordered by the most recent usage.
+        """
+        return list(self)
 
     def __contains__(self, key):
         """
@@ -572,7 +623,7 @@ class CacheDict(object):
     def __repr__(self):
         return '<%s %r>' % (
             self.__class__.__name__,
-            self._mapping
+            dict([(k, n[3]) for k, n in self._mapping.iteritems()])
         )
 
     def __getitem__(self, key):
@@ -582,56 +633,98 @@ class CacheDict(object):
 
         Raise an `KeyError` if it does not exist.
         """
-        rv = self._mapping[key]
-        if self._queue[-1] != key:
-            self._remove(key)
-            self._append(key)
-        return rv
+        try:
+            node = self._mapping[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        root = self._root
+        last = root[0]
+        if node is not last:
+            prev, next = node[0], node[1]
+            prev[1] = next
+            next[0] = prev
+            node[0] = last
+            node[1] = root
+            last[1] = root[0] = node
+        return node[3]
 
     def __setitem__(self, key, value):
         """
         Sets the value for an item. Moves the item up so that it
         has the highest priority then.
         """
-        if key in self._mapping:
-            self._remove(key)
-        elif len(self._mapping) == self.capacity:
-            del self._mapping[self._popleft()]
-        self._append(key)
-        self._mapping[key] = value
+        if self.weigh is not None:
+            weight = self.weigh(value)
+        else:
+            weight = 0
+        node = self._mapping.get(key)
+        if node is not None:
+            self._unlink(node)
+        # too heavy to keep, but that's no reason to drop anything else
+        if self.max_weight is not None and weight > self.max_weight:
+            return
+        root = self._root
+        last = root[0]
+        last[1] = root[0] = self._mapping[key] = [last, root, key, value,
+                                                  weight]
+        self.weight += weight
+
+        # forget about the least recently used items
+        while len(self._mapping) > self.capacity or \
+              (self.max_weight is not None and
+               self.weight > self.max_weight):
+            self._unlink(root[1])
+            self.evictions += 1
 
     def __delitem__(self, key):
         """
         Remove an item from the cache dict.
         Raise an `KeyError` if it does not exist.
         """
-        del self._mapping[key]
-        self._remove(key)
+        self._unlink(self._mapping[key])
+
+    def _unlink(self, node):
+        """Remove a node from the linked list and the mapping."""
+        prev, next = node[0], node[1]
+        prev[1] = next
+        next[0] = prev
+        del self._mapping[node[2]]
+        self.weight -= node[4]
 
     def __iter__(self):
         """
         Iterate over all values in the cache dict, ordered by
         the most recent usage.
         """
-        return reversed(self._queue)
+        root = self._root
+        node = root[0]
+        while node is not root:
+            yield node[2]
+            node = node[0]
 
     def __reversed__(self):
         """
         Iterate over the values in the cache dict, oldest items
         coming first.
         """
-        return iter(self._queue)
+        root = self._root
+        node = root[1]
+        while node is not root:
+            yield node[2]
+            node = node[1]
 
     __copy__ = copy
 
-    def __deepcopy__(self):
+    def __deepcopy__(self, memo=None):
         """
         Return a deep copy of the cache dict.
         """
         from copy import deepcopy
-        rv = CacheDict(self.capacity)
-        rv._mapping = deepcopy(self._mapping)
-        rv._queue = deepcopy(self._queue)
+        rv = CacheDict(self.capacity, self.max_weight, self.weigh)
+        for key in self.__reversed__():
+            rv[deepcopy(key, memo)] = deepcopy(self._mapping[key][3], memo)
         return rv
 
 
@@ -0,0 +1,47 @@
+# Compile all templates in the git repo into one bundle
+#
+#    python mkbundle.py [filename]
+#
+# The filename defaults to settings.bundle. The templates are compiled
+# with the environment the blog renders them with.
+import sys
+import settings
+from jinja.bundle import write_bundle
+from templates import tenv
+
+def compile_templates(env):
+    versions = env.loader.get_source_versions(env)
+    seen = {}
+    names = versions.keys()
+    names.sort()
+    for name in names:
+        if versions[name] in seen:
+            continue
+        try:
+            tmpl = env.loader.translate(env, name)
+        except Exception, e:
+            sys.stderr.write("skipping %s: %s: %s\n" % (name,
+                             e.__class__.__name__, e))
+            continue
+        seen[versions[name]] = True
+        yield env.loader.get_bundle_entry(env, name, tmpl, versions)
+
+def main(args):
+    if args:
+        filename = args[0]
+    else:
+        filename = settings.bundle
+    if filename == None:
+        sys.stderr.write("usage: mkbundle.py filename\n")
+        return 1
+    if tenv.profiler is not None:
+        # the timing code needs a profiler at runtime
+        sys.stderr.write("disable settings.profile to write a bundle\n")
+        return 1
+    entries = list(compile_templates(tenv))
+    write_bundle(filename, entries)
+    print "%d templates written to %s" % (len(entries), filename)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
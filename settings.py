@@ -12,6 +12,15 @@ index='index'
 # Tree in the git repo of templates
 templates='html'
 
+# Bundle of precompiled templates written by mkbundle.py, None
+# compiles the templates from the git repo on demand
+bundle=None
+
+# Record render times of templates, blocks, macros and includes
+# and show them on /_profile (templates are compiled without the
+# bundle then)
+profile=False
+
 # Default revision for the blog (can be a tag, HEAD^^,
 # whatever as long as git takes it)
 revision='HEAD'
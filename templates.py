@@ -0,0 +1,41 @@
+# Templates from the git repo
+import os
+import git
+import settings
+from jinja import Environment
+from jinja.profiler import Profiler
+from jinja.loaders import BaseFunctionLoader, BundleLoaderMixin
+
+def load_template(templ):
+    (res, err) = git.show(settings.templates + '/' + templ)
+    return res
+
+# Looks templates up in the bundle by the SHA of their blob so a
+# bundle never serves a template that changed in the repo.
+class GitLoader(BundleLoaderMixin, BaseFunctionLoader):
+    def __init__(self, bundle=None):
+        BaseFunctionLoader.__init__(self, load_template)
+        BundleLoaderMixin.__init__(self, bundle)
+
+    def get_source_versions(self, environment):
+        (res, ret) = git.blobs(settings.templates)
+        return res
+
+    # Only ask git for the blob SHAs again once a ref moved
+    def get_versions_key(self, environment):
+        return git.refs_stamp()
+
+# The templates in the bundle have no timing code
+def get_bundle():
+    if settings.profile:
+        return None
+    if settings.bundle != None and os.path.exists(settings.bundle):
+        return settings.bundle
+    return None
+
+def get_profiler():
+    if settings.profile:
+        return Profiler()
+    return None
+
+tenv = Environment(loader=GitLoader(get_bundle()), profiler=get_profiler())
@@ -12,25 +12,20 @@ __all__ = [
   "sqllist", "sqlors", "aparam", "reparam",
   "SQLQuery", "sqlquote",
   "SQLLiteral", "sqlliteral",
-  "connect", 
+  "connect", "ConnectionPool", "PoolError",
+  "queryhooks", "querystats",
   "TransactionError", "transaction", "transact", "commit", "rollback",
-  "query",
-  "select", "insert", "update", "delete"
+  "Row", "query",
+  "select", "insert", "multiple_insert", "update", "delete"
 ]
 
-import time
+import time, threading, re
 try: import datetime
 except ImportError: datetime = None
 
 from utils import storage, iters, iterbetter
 import webapi as web
 
-try:
-    from DBUtils import PooledDB
-    web.config._hasPooling = True
-except ImportError:
-    web.config._hasPooling = False
-
 class _ItplError(ValueError):
     def __init__(self, text, pos):
         ValueError.__init__(self)
@@ -139,6 +134,35 @@ def aparam():
         return '%s'
     raise UnknownParamstyle, style
 
+_parsed = {}
+_parsed_max = 1000
+
+def _parse(string_):
+    """
+    Like `_interpolate`, but with the live chunks compiled, and cached:
+    the same query text is only ever tokenized once.
+    
+        >>> _parse("x = $x")[0]
+        (0, 'x = ')
+    """
+    try:
+        return _parsed[string_]
+    except KeyError:
+        pass
+    
+    chunks = []
+    for live, chunk in _interpolate(string_):
+        if live:
+            chunk = compile(chunk, '<sql>', 'eval')
+        chunks.append((live, chunk))
+    chunks = tuple(chunks)
+    
+    # like the re module, just start over when the cache is full
+    if len(_parsed) >= _parsed_max:
+        _parsed.clear()
+    _parsed[string_] = chunks
+    return chunks
+
 def reparam(string_, dictionary):
     """
     Takes a string and a dictionary and interpolates the string
@@ -151,7 +175,7 @@ def reparam(string_, dictionary):
     dictionary = dictionary.copy()
     vals = []
     result = []
-    for live, chunk in _interpolate(string_):
+    for live, chunk in _parse(string_):
         if live:
             result.append(aparam())
             vals.append(eval(chunk, dictionary))
@@ -249,14 +273,339 @@ class UnknownDB(Exception):
     """raised for unsupported dbms"""
     pass
 
+class PoolError(Exception):
+    """raised when no pooled connection becomes free in time"""
+    pass
+
+class ConnectionPool:
+    """
+    A thread-safe pool of DB-API connections.
+    
+    Connections are made with `creator(**keywords)`, passed to `setup`
+    (if given) once, handed out by `connection()` and given back with
+    `release(conn)`. `minconn` connections are opened up front and at
+    most `maxconn` are open at once (0 means no limit); past that,
+    `connection()` waits up to `timeout` seconds (forever if None) and
+    then raises `PoolError`. A connection which has been idle for more
+    than `ping` seconds is checked with `pingquery` before it is reused.
+    
+    With `threadlocal=True` every thread keeps a connection of its own
+    for good, which is what sqlite needs.
+    """
+    def __init__(self, creator, keywords, minconn=0, maxconn=0, ping=60,
+                 timeout=None, pingquery="SELECT 1", threadlocal=False,
+                 setup=None):
+        self.creator = creator
+        self.keywords = keywords
+        self.maxconn = maxconn
+        self.ping = ping
+        self.timeout = timeout
+        self.pingquery = pingquery
+        self.threadlocal = threadlocal
+        self.setup = setup
+        
+        self._lock = threading.Condition()
+        self._idle = []
+        self._open = 0
+        self._local = {}
+        
+        if not threadlocal:
+            for i in range(minconn):
+                self._idle.append((self._connect(), time.time()))
+                self._open += 1
+    
+    def _connect(self):
+        conn = self.creator(**self.keywords)
+        if self.setup:
+            self.setup(conn)
+        return conn
+    
+    def _close(self, conn):
+        try: 
+            conn.close()
+        except Exception: 
+            pass
+    
+    def _alive(self, conn):
+        try:
+            cur = conn.cursor()
+            cur.execute(self.pingquery)
+            cur.fetchall()
+            cur.close()
+            conn.rollback()
+        except Exception:
+            return False
+        return True
+    
+    def connection(self):
+        """Checks a connection out of the pool."""
+        if self.threadlocal:
+            return self._localconnection()
+        
+        conn = None
+        self._lock.acquire()
+        try:
+            if self.timeout is not None:
+                deadline = time.time() + self.timeout
+            while not self._idle and self.maxconn and \
+              self._open >= self.maxconn:
+                if self.timeout is None:
+                    self._lock.wait()
+                else:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        raise PoolError, "no connection free after %ss" % \
+                          self.timeout
+                    self._lock.wait(left)
+            if self._idle:
+                conn, since = self._idle.pop()
+            else:
+                self._open += 1
+        finally:
+            self._lock.release()
+        
+        if conn is not None:
+            if time.time() - since <= self.ping or self._alive(conn):
+                return conn
+            self._close(conn)
+        
+        try:
+            return self._connect()
+        except:
+            self._forget()
+            raise
+    
+    def _localconnection(self):
+        thread = threading.currentThread()
+        conn = self._local.get(thread)
+        if conn is None:
+            self._lock.acquire()
+            try:
+                # connections of finished threads can't be reused
+                for t in self._local.keys():
+                    if not t.isAlive():
+                        self._close(self._local.pop(t))
+            finally:
+                self._lock.release()
+            conn = self._local[thread] = self._connect()
+        return conn
+    
+    def release(self, conn):
+        """Gives a connection checked out by `connection()` back."""
+        if self.threadlocal:
+            return
+        self._lock.acquire()
+        try:
+            self._idle.append((conn, time.time()))
+            self._lock.notify()
+        finally:
+            self._lock.release()
+    
+    def discard(self, conn):
+        """Closes a checked out connection instead of giving it back."""
+        if self.threadlocal:
+            self._local.pop(threading.currentThread(), None)
+            self._close(conn)
+            return
+        self._close(conn)
+        self._forget()
+    
+    def _forget(self):
+        self._lock.acquire()
+        try:
+            self._open -= 1
+            self._lock.notify()
+        finally:
+            self._lock.release()
+    
+    def close(self):
+        """Closes all idle connections."""
+        self._lock.acquire()
+        try:
+            for conn, since in self._idle:
+                self._close(conn)
+                self._open -= 1
+            self._idle = []
+            for conn in self._local.values():
+                self._close(conn)
+            self._local = {}
+        finally:
+            self._lock.release()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _pool(key, db, keywords, options):
+    pool = _pools.get(key)
+    if pool is None:
+        _pools_lock.acquire()
+        try:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(db.connect, keywords, 
+                  **options)
+        finally:
+            _pools_lock.release()
+    return pool
+
+def _setup_postgres(conn):
+    # fix for Bug#177265
+    try:
+        conn.set_client_encoding('UTF8')
+    except Exception, e:
+        print >> web.debug, 'Error in setting utf-8 encoding:', str(e), '(ignored)' 
+
+def _release():
+    """Gives the context's connection back to its pool. Run on `unload`."""
+    pool = web.ctx.get('db_pool')
+    conn = web.ctx.get('db')
+    if pool is None or conn is None or isinstance(conn, dict):
+        return
+    web.ctx.db = pool.keywords
+    web.ctx.db_transaction = 0
+    # plain queries are never committed, so the connection may still be
+    # in a transaction holding locks and an old snapshot
+    try:
+        conn.rollback()
+    except Exception:
+        pool.discard(conn)
+        return
+    pool.release(conn)
+
+web.unloadhooks['db'] = _release
+
+queryhooks = {}
+
+_querystats = {}
+_querystats_max = 1000
+_slowqueries = []
+_slowqueries_max = 100
+_stats_lock = threading.Lock()
+
+_shapes = {}
+_shapes_max = 1000
+_literal_re = re.compile(r"'(?:[^']|'')*'|%s|:\d+|\b\d+(?:\.\d+)?\b")
+_paramlist_re = re.compile(r"\?(?:, \?)+")
+_rowlist_re = re.compile(r"(\([^()]*\))(?:, \1)+")
+
+def _shape(s):
+    """
+    Normalizes query text so that queries differing only in their
+    values look the same.
+    
+        >>> _shape("SELECT * FROM foo WHERE id IN (%s, %s, %s)  LIMIT 5")
+        'SELECT * FROM foo WHERE id IN (?, ...) LIMIT ?'
+        >>> _shape("INSERT INTO foo (a, b) VALUES (?, ?), (?, ?), (?, ?)")
+        'INSERT INTO foo (a, b) VALUES (?, ...), ...'
+    """
+    try:
+        return _shapes[s]
+    except KeyError:
+        pass
+    shape = ' '.join(_literal_re.sub('?', s).split())
+    shape = _paramlist_re.sub('?, ...', shape)
+    shape = _rowlist_re.sub(r'\1, ...', shape)
+    if len(_shapes) >= _shapes_max:
+        _shapes.clear()
+    _shapes[s] = shape
+    return shape
+
+def _record(sql_query, seconds):
+    """Records a query which took `seconds` to run. See `querystats`."""
+    web.ctx.dbq_time += seconds
+    
+    shape = _shape(sql_query.s)
+    _stats_lock.acquire()
+    try:
+        stat = _querystats.get(shape)
+        if stat is None:
+            if len(_querystats) >= _querystats_max:
+                shape = '(other)'
+                stat = _querystats.get(shape)
+            if stat is None:
+                stat = _querystats[shape] = [0, 0.0, 0.0]
+        stat[0] += 1
+        stat[1] += seconds
+        if seconds > stat[2]:
+            stat[2] = seconds
+    finally:
+        _stats_lock.release()
+    
+    threshold = web.config.get('db_slow_query')
+    if threshold is not None and seconds >= threshold:
+        slow = storage(time=time.time(), seconds=seconds, 
+                       path=web.ctx.get('path'), query=str(sql_query))
+        _stats_lock.acquire()
+        try:
+            _slowqueries.append(slow)
+            del _slowqueries[:-_slowqueries_max]
+        finally:
+            _stats_lock.release()
+        print >> web.debug, 'SLOW %s: %s' % (round(seconds, 3), slow.query)
+    
+    for x in queryhooks.values(): x(sql_query, seconds)
+
+def querystats(reset=False):
+    """
+    Returns what this process has recorded about the queries it ran:
+    
+    `shapes`
+       : A dictionary from each normalized query to a `storage` with
+         its `count` and the `total` and `max` seconds it took.
+    `slow`
+       : The latest queries slower than `web.config.db_slow_query`
+         seconds, oldest first, with their `time`, `seconds`, `path` and
+         `query`.
+    
+    If `reset` is true, starts over afterwards. The current request's
+    query count and total time are `web.ctx.dbq_count` and
+    `web.ctx.dbq_time`; to see every query as it happens, add a
+    function taking `(sql_query, seconds)` to `queryhooks`.
+    """
+    _stats_lock.acquire()
+    try:
+        shapes = dict([(shape, storage(count=n, total=total, max=longest))
+                       for shape, (n, total, longest) in _querystats.items()])
+        slow = _slowqueries[:]
+        if reset:
+            _querystats.clear()
+            del _slowqueries[:]
+    finally:
+        _stats_lock.release()
+    return storage(shapes=shapes, slow=slow)
+
 def connect(dbn, **keywords):
     """
     Connects to the specified database. 
     
-    `dbn` currently must be "postgres", "mysql", or "sqlite". 
+    `dbn` currently must be "postgres", "mysql", "sqlite" or "firebird".
+    
+    Connections come from a `ConnectionPool` shared by every call with
+    the same parameters and go back to it on `web.unload`. It can be
+    tuned with the `pool_min`, `pool_max`, `pool_ping` and
+    `pool_timeout` keywords, or turned off with `pooling=False`.
+    sqlite connections stay with the thread that opened them.
+    
+    Calls with different pool keywords get pools of their own.
     
-    If DBUtils is installed, connection pooling will be used.
+        >>> _ = connect('sqlite', db=':memory:', pool_max=1)
+        >>> pool = web.ctx.db_pool
+        >>> _ = connect('sqlite', db=':memory:', pool_max=2)
+        >>> web.ctx.db_pool is pool, web.ctx.db_pool.maxconn
+        (False, 2)
+        >>> _ = connect('sqlite', db=':memory:', pool_max=1)
+        >>> web.ctx.db_pool is pool
+        True
+        >>> web.ctx.clear()
     """
+    pooling = keywords.pop('pooling', True)
+    options = {}
+    for k, option in (('pool_min', 'minconn'), ('pool_max', 'maxconn'),
+                      ('pool_ping', 'ping'), ('pool_timeout', 'timeout')):
+        if k in keywords:
+            options[option] = keywords.pop(k)
+    setup = None
+    
     if dbn == "postgres": 
         try: 
             import psycopg2 as db
@@ -274,6 +623,7 @@ def connect(dbn, **keywords):
             del keywords['pw']
         keywords['database'] = keywords['db']
         del keywords['db']
+        setup = _setup_postgres
 
     elif dbn == "mysql":
         import MySQLdb as db
@@ -292,7 +642,7 @@ def connect(dbn, **keywords):
                 db.paramstyle = 'qmark'
             except ImportError:
                 import sqlite as db
-        web.config._hasPooling = False
+        options['threadlocal'] = True
         keywords['database'] = keywords['db']
         del keywords['db']
     
@@ -303,6 +653,7 @@ def connect(dbn, **keywords):
             del keywords['pw']
         keywords['database'] = keywords['db']
         del keywords['db']
+        options['pingquery'] = "SELECT 1 FROM rdb$database"
 
     else: 
         raise UnknownDB, dbn
@@ -311,40 +662,28 @@ def connect(dbn, **keywords):
     web.ctx.db_module = db
     web.ctx.db_transaction = 0
     web.ctx.db = keywords
-
-    def _PooledDB(db, keywords):
-        # In DBUtils 0.9.3, `dbapi` argument is renamed as `creator`
-        # see Bug#122112
-        if PooledDB.__version__.split('.') < '0.9.3'.split('.'):
-            return PooledDB.PooledDB(dbapi=db, **keywords)
-        else:
-            return PooledDB.PooledDB(creator=db, **keywords)
+    web.ctx.db_key = (dbn, repr(sorted(keywords.items())))
+    if pooling:
+        key = (web.ctx.db_key, repr(sorted(options.items())))
+        options['setup'] = setup
+        web.ctx.db_pool = _pool(key, db, keywords, options)
+    else:
+        web.ctx.db_pool = None
     
     def db_cursor():
         if isinstance(web.ctx.db, dict):
-            keywords = web.ctx.db
-            if web.config._hasPooling:
-                if 'db' not in globals(): 
-                    globals()['db'] = _PooledDB(db, keywords)
-                web.ctx.db = globals()['db'].connection()
+            if web.ctx.db_pool:
+                web.ctx.db = web.ctx.db_pool.connection()
             else:
-                web.ctx.db = db.connect(**keywords)  
-    
-            # fix for Bug#177265
-            if web.ctx.get('db_name') == "postgres":
-                try:
-                    if web.config._hasPooling:
-                        # hack to call a function in actual db connection
-                        web.ctx.db._con._con.set_client_encoding('UTF8')
-                    else:
-                        web.ctx.db.set_client_encoding('UTF8')
-                except Exception, e:
-                   print >> web.debug, 'Error in setting utf-8 encoding:', str(e), '(ignored)' 
+                web.ctx.db = db.connect(**web.ctx.db)
+                if setup: 
+                    setup(web.ctx.db)
 
         return web.ctx.db.cursor()
     web.ctx.db_cursor = db_cursor
 
     web.ctx.dbq_count = 0
+    web.ctx.dbq_time = 0.0
     
     def db_execute(cur, sql_query, dorollback=True):
         """executes an sql query"""
@@ -361,6 +700,8 @@ def connect(dbn, **keywords):
             if dorollback and not web.ctx.db_transaction: web.ctx.db.rollback() 
             raise
 
+        _written(sql_query.s)
+        _record(sql_query, b - a)
         if web.config.get('db_printing'):
             print >> web.debug, '%s (%s): %s' % (round(b-a, 2), web.ctx.dbq_count, str(sql_query))
 
@@ -409,13 +750,34 @@ def commit():
     if not web.ctx.db_transaction:
         if hasattr(web.ctx.db, 'commit'): 
             web.ctx.db.commit()
+        # others may have cached what they read before we committed
+        for table in web.ctx.pop('db_written', ()):
+            _resultcache.invalidate(table)
     else:
         db_cursor = web.ctx.db_cursor()
         web.ctx.db_execute(db_cursor, 
             SQLQuery("RELEASE SAVEPOINT webpy_sp_%s" % web.ctx.db_transaction))
 
 def rollback(care=True):
-    """Rolls back a transaction."""
+    """
+    Rolls back a transaction. Results cached for the tables written in
+    the transaction are dropped, so nobody sees rows that were never
+    committed.
+    
+        >>> _ = connect('sqlite', db=':memory:', pooling=False)
+        >>> _ = query("CREATE TABLE rb (x int)")
+        >>> _ = insert('rb', seqname=False, x=1)
+        >>> query("SELECT count(*) AS n FROM rb", cache=60)[0].n
+        1
+        >>> transact()
+        >>> _ = insert('rb', seqname=False, x=2)
+        >>> query("SELECT count(*) AS n FROM rb", cache=60)[0].n
+        2
+        >>> rollback()
+        >>> query("SELECT count(*) AS n FROM rb", cache=60)[0].n
+        1
+        >>> web.ctx.clear()
+    """
     web.ctx.db_transaction -= 1     
     if web.ctx.db_transaction < 0:
         web.ctx.db_transaction = 0
@@ -427,18 +789,229 @@ def rollback(care=True):
     if not web.ctx.db_transaction:
         if hasattr(web.ctx.db, 'rollback'): 
             web.ctx.db.rollback()
+        for table in web.ctx.pop('db_written', ()):
+            _resultcache.invalidate(table)
     else:
         db_cursor = web.ctx.db_cursor()
         web.ctx.db_execute(db_cursor,
             SQLQuery("ROLLBACK TO SAVEPOINT webpy_sp_%s" % web.ctx.db_transaction),
             dorollback=False)
 
-def query(sql_query, vars=None, processed=False, _test=False):
+class _ResultCache:
+    """
+    The results cached by `query(..., cache=seconds)`, limited to about
+    `web.config.db_cache_bytes` bytes in all (default: 10MB).
+    
+    Each entry is filed under every word of its query, so invalidating
+    a table drops every result whose query mentions the table's name.
+    That may drop a bit more than needed, but never too little.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.words = {}
+        self.size = 0
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            self.lock.acquire()
+            try:
+                self._drop(key)
+            finally:
+                self.lock.release()
+            return None
+        return entry[2]
+    
+    def set(self, key, rows, ttl, sql):
+        # rough, but cheaper than anything exact
+        size = 64 + sum([len(repr(row)) for row in rows])
+        limit = web.config.get('db_cache_bytes', 10 * 1024 * 1024)
+        if size > limit:
+            return
+        words = dict.fromkeys(_word_re.findall(sql.lower()))
+        self.lock.acquire()
+        try:
+            self._drop(key)
+            self.entries[key] = (time.time() + ttl, size, rows, words)
+            for word in words:
+                self.words.setdefault(word, {})[key] = True
+            self.size += size
+            if self.size > limit:
+                self._evict(limit)
+        finally:
+            self.lock.release()
+    
+    def invalidate(self, table):
+        table = table.split('.')[-1].strip('"`').lower()
+        self.lock.acquire()
+        try:
+            for key in self.words.get(table, {}).keys():
+                self._drop(key)
+        finally:
+            self.lock.release()
+    
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries, self.words, self.size = {}, {}, 0
+        finally:
+            self.lock.release()
+    
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry[1]
+        for word in entry[3]:
+            keys = self.words[word]
+            del keys[key]
+            if not keys:
+                del self.words[word]
+    
+    def _evict(self, limit):
+        # expired entries go first, then the ones closest to expiring
+        now = time.time()
+        entries = self.entries.items()
+        entries.sort(key=lambda (key, entry): entry[0])
+        for key, entry in entries:
+            if self.size <= limit and entry[0] >= now:
+                break
+            self._drop(key)
+
+_resultcache = _ResultCache()
+_word_re = re.compile(r"\w+")
+_write_re = re.compile(r"\s*(?:insert\s+into|replace\s+into|update|delete\s+from)"
+                       r"\s+([\w.\"`]+(?:\s*,\s*[\w.\"`]+)*)", re.I)
+
+def _written(sql):
+    """Invalidates cached results which `sql` may have changed."""
+    match = _write_re.match(sql)
+    if not match:
+        return
+    tables = [t.strip() for t in match.group(1).split(',')]
+    for table in tables:
+        _resultcache.invalidate(table)
+    if web.ctx.db_transaction:
+        web.ctx.db_written = web.ctx.get('db_written', []) + tables
+
+def _cachedresult(rows):
+    if web.config.get('db_storage'):
+        # those can be changed, so everyone gets their own
+        rows = [storage(row) for row in rows]
+    out = iterbetter(iter(rows))
+    out.__len__ = lambda: len(rows)
+    out.list = lambda: list(rows)
+    return out
+
+class Row(tuple):
+    """
+    A result row. Each set of column names gets its own subclass, so a
+    row is just a tuple of the values which also allows `row.name`,
+    `row['name']` and the read-only dictionary methods.
+    
+        >>> r = _rowclass(['id', 'name'])((1, 'bob'))
+        >>> r.name, r['id'], r[0]
+        ('bob', 1, 1)
+        >>> r.items()
+        [('id', 1), ('name', 'bob')]
+        >>> r
+        <Row {'id': 1, 'name': 'bob'}>
+    
+    Rows can be pickled, they are unpickled as rows with the same names.
+    
+        >>> import pickle
+        >>> pickle.loads(pickle.dumps(r, 2)).name
+        'bob'
+    
+    Unlike `storage`, rows can't be changed; set `web.config.db_storage`
+    to get `storage` objects instead.
+    """
+    __slots__ = ()
+    _names = ()
+    _index = {}
+    
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            try:
+                key = self._index[key]
+            except KeyError:
+                raise KeyError, key
+        return tuple.__getitem__(self, key)
+    
+    def __getattr__(self, key):
+        # only names which aren't identifiers end up here
+        try:
+            return self[key]
+        except KeyError, k:
+            raise AttributeError, k
+    
+    def __iter__(self): 
+        return iter(self._names)
+    
+    def __contains__(self, key): 
+        return key in self._index
+    
+    has_key = __contains__
+    
+    def get(self, key, default=None):
+        if key in self._index:
+            return self[key]
+        return default
+    
+    def keys(self): 
+        return list(self._names)
+    
+    def values(self): 
+        return list(tuple.__iter__(self))
+    
+    def items(self): 
+        return zip(self._names, tuple.__iter__(self))
+    
+    def __repr__(self):
+        return '<Row ' + repr(dict(self.items())) + '>'
+    
+    def __reduce__(self):
+        # the subclasses are made on the fly, so pickle the names instead
+        return (_makerow, (self._names, tuple(self.values())))
+
+_rowclasses = {}
+
+def _rowclass(names):
+    """Returns the `Row` subclass for the column `names`."""
+    names = tuple(names)
+    cls = _rowclasses.get(names)
+    if cls is None:
+        attrs = dict(__slots__=(), _names=names, 
+          _index=dict([(n, i) for i, n in enumerate(names)]))
+        for i, name in enumerate(names):
+            if name not in Row.__dict__:
+                attrs[name] = property(_itemgetter(i))
+        cls = _rowclasses[names] = type('Row', (Row,), attrs)
+    return cls
+
+def _makerow(names, values):
+    """Returns a `Row` with the column `names` and `values`."""
+    return _rowclass(names)(values)
+
+def _itemgetter(i):
+    getitem = tuple.__getitem__
+    return lambda self: getitem(self, i)
+
+def query(sql_query, vars=None, processed=False, cache=None, _test=False):
     """
     Execute SQL query `sql_query` using dictionary `vars` to interpolate it.
     If `processed=True`, `vars` is a `reparam`-style list to use 
     instead of interpolating.
     
+    If `cache` is a number of seconds, the rows are kept that long and
+    the same query with the same values gets them back without asking
+    the database. Writing to a table through `web.db` drops the cached
+    results of every query mentioning it. Inside a transaction the cache
+    is neither read nor filled, since the rows may never be committed.
+    
         >>> query("SELECT * FROM foo", _test=True)
         <sql: 'SELECT * FROM foo'>
         >>> query("SELECT * FROM foo WHERE x = $x", vars=dict(x='f'), _test=True)
@@ -453,21 +1026,44 @@ def query(sql_query, vars=None, processed=False, _test=False):
     
     if _test: return sql_query
     
+    if web.ctx.get('db_transaction') or web.ctx.get('db_written'):
+        cache = None
+    
+    if cache:
+        key = (web.ctx.db_key, sql_query.s, sql_query.v)
+        try:
+            rows = _resultcache.get(key)
+        except TypeError: # unhashable values
+            cache = None
+        else:
+            if rows is not None:
+                return _cachedresult(rows)
+    
     db_cursor = web.ctx.db_cursor()
     web.ctx.db_execute(db_cursor, sql_query)
     
     if db_cursor.description:
         names = [x[0] for x in db_cursor.description]
+        if web.config.get('db_storage'):
+            makerow = lambda row: storage(dict(zip(names, row)))
+        else:
+            makerow = _rowclass(names)
+        fetchsize = web.config.get('db_fetchsize', 100)
         def iterwrapper():
-            row = db_cursor.fetchone()
-            while row:
-                yield storage(dict(zip(names, row)))
-                row = db_cursor.fetchone()
+            while True:
+                rows = db_cursor.fetchmany(fetchsize)
+                if not rows:
+                    break
+                for row in rows:
+                    yield makerow(row)
         out = iterbetter(iterwrapper())
         if web.ctx.db_name != "sqlite":
             out.__len__ = lambda: int(db_cursor.rowcount)
-        out.list = lambda: [storage(dict(zip(names, x))) \
-                           for x in db_cursor.fetchall()]
+        out.list = lambda: map(makerow, db_cursor.fetchall())
+        if cache:
+            rows = out.list()
+            _resultcache.set(key, rows, cache, sql_query.s)
+            out = _cachedresult(rows)
     else:
         out = db_cursor.rowcount
     
@@ -535,11 +1131,11 @@ def sqlwhere(dictionary, grouping=' AND '):
     ]), dictionary.values())
 
 def select(tables, vars=None, what='*', where=None, order=None, group=None, 
-           limit=None, offset=None, _test=False):
+           limit=None, offset=None, cache=None, _test=False):
     """
     Selects `what` from `tables` with clauses `where`, `order`, 
     `group`, `limit`, and `offset`. Uses vars to interpolate. 
-    Otherwise, each clause can be a SQLQuery.
+    Otherwise, each clause can be a SQLQuery. `cache` is as in `query`.
     
         >>> select('foo', _test=True)
         <sql: 'SELECT * FROM foo'>
@@ -602,7 +1198,7 @@ def select(tables, vars=None, what='*', where=None, order=None, group=None,
         qout += gen_clause(sql, val)
 
     if _test: return qout
-    return query(qout, processed=True)
+    return query(qout, processed=True, cache=cache)
 
 def insert(tablename, seqname=None, _test=False, **values):
     """
@@ -650,6 +1246,90 @@ def insert(tablename, seqname=None, _test=False, **values):
 
     return out
 
+def multiple_insert(tablename, values, seqname=None, batch_size=100, 
+                    _test=False):
+    """
+    Inserts the dictionaries in `values`, which must all have the same
+    keys, into `tablename`. Rows are sent `batch_size` at a time in
+    multi-row INSERT statements, all in one transaction. Returns the
+    list of new IDs; `seqname` is as in `insert`.
+    
+        >>> multiple_insert('foo', [dict(a=1, b=2), dict(a=3, b=4)], _test=True)
+        [<sql: 'INSERT INTO foo (a, b) VALUES (1, 2), (3, 4)'>]
+    
+    The IDs are worked out from the last one of each batch, so they
+    are only right if nothing else uses the sequence meanwhile. If
+    `seqname` is False or the database can't tell the last ID (anything
+    but postgres, mysql and sqlite), it returns None instead.
+    
+    Rows may list their keys in any order:
+    
+        >>> multiple_insert('foo', [dict(a=1, b=2), dict(b=4, a=3)], _test=True)
+        [<sql: 'INSERT INTO foo (a, b) VALUES (1, 2), (3, 4)'>]
+    """
+    values = list(values)
+    if not values:
+        return []
+    
+    keys = values[0].keys()
+    keyset = set(keys)
+    for row in values:
+        if set(row) != keyset:
+            raise ValueError, "all rows must have the same keys"
+    
+    dbn = web.ctx.get('db_name')
+    if dbn == "sqlite":
+        # sqlite allows at most 999 parameters per statement
+        batch_size = max(1, min(batch_size, 999 // len(keys)))
+    elif dbn == "firebird":
+        # no multi-row VALUES
+        batch_size = 1
+    
+    head = "INSERT INTO %s (%s) VALUES " % (tablename, ", ".join(keys))
+    rowparams = "(" + ", ".join([aparam() for k in keys]) + ")"
+    batches = [values[i:i + batch_size] 
+               for i in range(0, len(values), batch_size)]
+    queries = [SQLQuery(head + ", ".join([rowparams] * len(batch)),
+                        [row[k] for row in batch for k in keys])
+               for batch in batches]
+    
+    if _test: return queries
+    
+    if seqname is False or dbn not in ("postgres", "mysql", "sqlite"):
+        lastid = None
+    elif dbn == "postgres":
+        if seqname is None:
+            seqname = tablename + "_id_seq"
+        lastid = SQLQuery("SELECT currval('%s')" % seqname)
+    elif dbn == "mysql":
+        # the first ID of the batch, unlike the others
+        lastid = SQLQuery("SELECT last_insert_id()")
+    else:
+        lastid = SQLQuery("SELECT last_insert_rowid()")
+    
+    db_cursor = web.ctx.db_cursor()
+    out = []
+    transact()
+    try:
+        for sql_query, batch in zip(queries, batches):
+            web.ctx.db_execute(db_cursor, sql_query)
+            if lastid is None:
+                continue
+            web.ctx.db_execute(db_cursor, lastid)
+            n = db_cursor.fetchone()[0]
+            if dbn == "mysql":
+                out.extend(range(n, n + len(batch)))
+            else:
+                out.extend(range(n - len(batch) + 1, n + 1))
+    except:
+        rollback()
+        raise
+    commit()
+    
+    if lastid is None:
+        return None
+    return out
+
 def update(tables, where, vars=None, _test=False, **values):
     """
     Update `tables` with clause `where` (interpolated using `vars`)
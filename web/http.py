@@ -178,12 +178,16 @@ def background(func):
 
         def newfunc():
             web._context[threading.currentThread()] = tmpctx
+            import db
             # Create new db cursor if there is one else background thread
             # overwrites foreground cursor causing rubbish data into dbase
             if web.config.get('db_parameters'):
-                import db
                 db.connect(**web.config.db_parameters)
-            func(*a, **kw)
+            try:
+                func(*a, **kw)
+            finally:
+                # give the pooled connection back; nothing unloads us
+                db._release()
             myctx = web._context[threading.currentThread()]
             for k in myctx.keys():
                 if k not in ['status', 'headers', 'output']:
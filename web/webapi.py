@@ -29,6 +29,18 @@ A configuration object for various aspects of web.py.
 `db_printing`
    : Set to `True` if you would like SQL queries and timings to be
      printed to the debug output.
+`db_slow_query`
+   : Queries taking at least this many seconds are printed to the
+     debug output and kept for `web.db.querystats`.
+`db_cache_bytes`
+   : Roughly how much memory query results cached with `cache=seconds`
+     may use (default: 10MB).
+`db_fetchsize`
+   : How many rows query results fetch from the database at a time
+     (default: 100).
+`db_storage`
+   : Set to `True` to get query results as `storage` objects rather
+     than the lighter, read-only `web.db.Row`.
 
 """
 
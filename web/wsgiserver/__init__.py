@@ -354,6 +354,15 @@ class HTTPRequest(object):
 
     def respond(self):
         """Call the appropriate WSGI app and write its iterable output."""
+        if self.connection.shed:
+            # Admitted only so we could look at it; serve it anyway if
+            # it's cheap, otherwise tell the client to come back later.
+            priority = self.connection.server.priority
+            if priority is None or not priority(self.environ):
+                self.close_connection = True
+                self.sendall(self.connection.server.shed_message())
+                return
+
         response = self.wsgi_app(self.environ, self.start_response)
         try:
             for chunk in response:
@@ -563,6 +572,8 @@ class HTTPConnection(object):
 
     rbufsize = -1
     RequestHandlerClass = HTTPRequest
+    shed = False
+    accepted = None
     environ = {"wsgi.version": (1, 0),
                "wsgi.url_scheme": "http",
                "wsgi.multithread": True,
@@ -672,18 +683,24 @@ class WorkerThread(threading.Thread):
     check its own 'ready' flag after it has started. To stop the thread,
     it is necessary to stick a _SHUTDOWNREQUEST object onto the Queue
     (one for each running WorkerThread).
+
+    requests: the Queue to poll; defaults to server.requests. Shedding
+        threads poll server.shed_requests instead.
     """
 
-    def __init__(self, server):
+    def __init__(self, server, requests=None):
         self.ready = False
         self.server = server
+        if requests is None:
+            requests = server.requests
+        self.requests = requests
         threading.Thread.__init__(self)
 
     def run(self):
         try:
             self.ready = True
             while True:
-                conn = self.server.requests.get()
+                conn = self.requests.get()
                 if conn is _SHUTDOWNREQUEST:
                     return
 
@@ -695,6 +712,15 @@ class WorkerThread(threading.Thread):
             self.server.interrupt = exc
 
 
+def conditional_request(environ):
+    """A `priority` callable for CherryPyWSGIServer which lets cache
+    revalidations (which usually end in a cheap 304) through while
+    shedding load."""
+    return (environ.get("REQUEST_METHOD") in ("GET", "HEAD") and
+            ("HTTP_IF_NONE_MATCH" in environ or
+             "HTTP_IF_MODIFIED_SINCE" in environ))
+
+
 class SSLConnection:
     """A thread-safe wrapper for an SSL.Connection.
 
@@ -753,6 +779,32 @@ class CherryPyWSGIServer(object):
     If either of these is None (both are None by default), this server
     will not use SSL. If both are given and are valid, they will be read
     on server start and used in the SSL context for the listening socket.
+
+
+    Load shedding
+    -------------
+    By default a full request Queue blocks the accept loop, so latency
+    grows without bound for everyone. Set either threshold to turn on
+    admission control instead:
+
+    shed_queue_depth: shed new connections once this many are queued.
+    shed_queue_age: shed new connections once the oldest queued one has
+        waited this many seconds.
+
+    While shedding (or whenever the Queue is full), new connections are
+    handed to a small pool of shedding threads which answer with a
+    minimal "503 Service Unavailable" and a Retry-After header.
+
+    retry_after: the Retry-After value, in seconds (default 5).
+    priority: a callable taking the WSGI environ; if it returns True
+        the shedding thread serves the request normally instead of
+        refusing it. Use it for cheap routes, e.g. conditional_request
+        lets 304 revalidations through.
+    shed_numthreads: the number of shedding threads (default 1).
+    shed_max: the maximum number of connections waiting for a shedding
+        thread (default 100). Beyond that, the 503 is written straight
+        from the accept loop without reading the request.
+    shed_timeout: the timeout in seconds for shed connections (default 2).
     """
 
     protocol = "HTTP/1.1"
@@ -765,6 +817,15 @@ class CherryPyWSGIServer(object):
     ssl_certificate = None
     ssl_private_key = None
 
+    # Admission control; see "Load shedding" above.
+    shed_queue_depth = None
+    shed_queue_age = None
+    retry_after = 5
+    priority = None
+    shed_numthreads = 1
+    shed_max = 100
+    shed_timeout = 2
+
     def __init__(self, bind_addr, wsgi_app, numthreads=10, server_name=None,
                  max=-1, request_queue_size=5, timeout=10):
         self.requests = Queue.Queue(max)
@@ -788,6 +849,7 @@ class CherryPyWSGIServer(object):
         self.server_name = server_name
         self.request_queue_size = request_queue_size
         self._workerThreads = []
+        self.shed_requests = None
 
         self.timeout = timeout
 
@@ -857,6 +919,11 @@ class CherryPyWSGIServer(object):
         # Create worker threads
         for i in xrange(self.numthreads):
             self._workerThreads.append(WorkerThread(self))
+        if self.shedding:
+            self.shed_requests = Queue.Queue(self.shed_max)
+            for i in xrange(self.shed_numthreads):
+                self._workerThreads.append(WorkerThread(self,
+                                                        self.shed_requests))
         for worker in self._workerThreads:
             worker.setName("CP WSGIServer " + worker.getName())
             worker.start()
@@ -896,10 +963,24 @@ class CherryPyWSGIServer(object):
             s, addr = self.socket.accept()
             if not self.ready:
                 return
-            if hasattr(s, 'settimeout'):
-                s.settimeout(self.timeout)
-            conn = self.ConnectionClass(s, addr, self)
-            self.requests.put(conn)
+            if not self.shedding:
+                if hasattr(s, 'settimeout'):
+                    s.settimeout(self.timeout)
+                conn = self.ConnectionClass(s, addr, self)
+                self.requests.put(conn)
+                return
+
+            if not self.overloaded():
+                if hasattr(s, 'settimeout'):
+                    s.settimeout(self.timeout)
+                conn = self.ConnectionClass(s, addr, self)
+                conn.accepted = time.time()
+                try:
+                    self.requests.put(conn, False)
+                    return
+                except Queue.Full:
+                    pass
+            self.shed(s, addr)
         except socket.timeout:
             # The only reason for the timeout in start() is so we can
             # notice keyboard interrupts on Win32, which don't interrupt
@@ -915,6 +996,56 @@ class CherryPyWSGIServer(object):
                 return
             raise
 
+    def _get_shedding(self):
+        return (self.shed_queue_depth is not None or
+                self.shed_queue_age is not None)
+    shedding = property(_get_shedding,
+                        doc="True if admission control is configured.")
+
+    def overloaded(self):
+        """Return True if new connections should be shed."""
+        requests = self.requests
+        if (self.shed_queue_depth is not None and
+                requests.qsize() >= self.shed_queue_depth):
+            return True
+        if self.shed_queue_age is not None:
+            requests.mutex.acquire()
+            try:
+                if requests.queue:
+                    oldest = requests.queue[0]
+                else:
+                    oldest = None
+            finally:
+                requests.mutex.release()
+            if oldest is not None and oldest.accepted is not None:
+                return time.time() - oldest.accepted >= self.shed_queue_age
+        return False
+
+    def shed(self, s, addr):
+        """Refuse (or, for priority requests, serve) an accepted socket
+        without putting it on the main Queue."""
+        if hasattr(s, 'settimeout'):
+            s.settimeout(self.shed_timeout)
+        conn = self.ConnectionClass(s, addr, self)
+        conn.shed = True
+        try:
+            self.shed_requests.put(conn, False)
+        except Queue.Full:
+            # Even the shedding threads are behind; don't read anything.
+            try:
+                conn.sendall(self.shed_message())
+            except socket.error:
+                pass
+            conn.close()
+
+    def shed_message(self):
+        """Return the raw 503 response written to shed connections."""
+        return ("%s 503 Service Unavailable\r\n"
+                "Retry-After: %s\r\n"
+                "Content-Length: 0\r\n"
+                "Connection: close\r\n\r\n" % (self.protocol,
+                                                  self.retry_after))
+
     def _get_interrupt(self):
         return self._interrupt
     def _set_interrupt(self, interrupt):
@@ -964,7 +1095,7 @@ class CherryPyWSGIServer(object):
         # Must shut down threads here so the code that calls
         # this method can know when all threads are stopped.
         for worker in self._workerThreads:
-            self.requests.put(_SHUTDOWNREQUEST)
+            worker.requests.put(_SHUTDOWNREQUEST)
 
         # Don't join currentThread (when stop is called inside a request).
         current = threading.currentThread()